@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test for the bot.
+
+Runs main.py in a child process against local stand-ins for the Telegram Bot
+API, Amazon and YOURLS, replays a synthetic stream of user messages at rising
+rates and reports, for each rate: throughput, p50/p95/p99 end-to-end latency
+(from the user's message to the bot's final post), event-loop lag of the bot
+and its memory growth. With --workers the bot runs split into a front-end
+and scrape workers sharing the SQLite job queue (loop lag and memory are
+the front-end's).
+
+Stubs (one local HTTP server):
+    /bot<token>/<method>   Telegram: getMe, getUpdates (long polling),
+                           sendMessage, sendPhoto, editMessageText, ...
+    /dp/<ASIN>             Amazon product page: any ASIN gets one of the corpus
+                           pages, with --amazon-latency, --amazon-errors (503)
+                           and --amazon-captchas
+    http://amzn.to/<ASIN>  short links, reached through HTTP_PROXY, 301 to /dp/
+    /yourls-api.php        YOURLS, with --yourls-latency
+
+Usage:
+    python bench/load_test.py --rates 2,5,10,20 --duration 15
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CORPUS = os.path.join(ROOT, 'bench', 'corpus')
+TOKEN = '123456:LOADTEST'
+CAPTCHA_PAGE = b'<html><body><form action="/errors/validateCaptcha">captcha</form></body></html>'
+CHATTER = ('ciao a tutti', 'qualcuno ha provato questo?', 'grazie!', 'che ne pensate?')
+
+def load_pages(path: str) -> list:
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.html'):
+            with open(os.path.join(path, name), 'rb') as f:
+                pages.append(f.read())
+    return pages
+
+def percentile(values: list, pct: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(len(values) * pct) - 1)]
+
+def multipart_fields(body: bytes) -> dict:
+    fields = {}
+    for name, value in re.findall(rb'name="([^"]+)"\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', body, re.S):
+        if name != b'photo':
+            fields[name.decode()] = value.decode('utf-8', 'replace')
+    return fields
+
+class TelegramStub:
+    """Bot API stand-in that feeds queued updates and times the bot's replies."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._cond = threading.Condition()
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._outstanding = {}
+        self.polling = threading.Event()
+        self.results = []
+
+    def enqueue(self, chat_id: int, text: str, stage: int, expects_reply: bool) -> None:
+        with self._cond:
+            message_id = self._new_message_id()
+            self._updates.append({
+                'update_id': self._next_update_id,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'username': f'load{chat_id}'},
+                    'text': text,
+                },
+            })
+            self._next_update_id += 1
+            if expects_reply:
+                self._outstanding.setdefault(chat_id, deque()).append((time.perf_counter(), stage))
+            self._cond.notify_all()
+
+    def _new_message_id(self) -> int:
+        self._next_message_id += 1
+        return self._next_message_id
+
+    def get_updates(self, params: dict) -> list:
+        self.polling.set()
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._cond:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return self._updates[:100]
+
+    def _finish(self, chat_id: int, ok: bool) -> None:
+        with self._cond:
+            queue = self._outstanding.get(chat_id)
+            if not queue:
+                return
+            enqueued_at, stage = queue.popleft()
+        self.results.append((stage, time.perf_counter(), time.perf_counter() - enqueued_at, ok))
+
+    def outstanding(self) -> int:
+        with self._cond:
+            return sum(len(queue) for queue in self._outstanding.values())
+
+    def message(self, chat_id: int, **extra) -> dict:
+        with self._cond:
+            message_id = self._new_message_id()
+        return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, **extra}
+
+    def call(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Load', 'username': 'load_bot'}
+        if method == 'getUpdates':
+            return self.get_updates(params)
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        chat_id = int(params.get('chat_id') or 0)
+        text = params.get('text') or ''
+        if method == 'sendPhoto':
+            self._finish(chat_id, True)
+            photo = [{'file_id': f'photo-{chat_id}-{time.monotonic_ns()}', 'file_unique_id': 'u', 'width': 500, 'height': 500}]
+            return self.message(chat_id, photo=photo, caption=params.get('caption'))
+        if method == 'sendMediaGroup':
+            self._finish(chat_id, True)
+            return [self.message(chat_id, photo=[{'file_id': 'g', 'file_unique_id': 'g', 'width': 1, 'height': 1}])]
+        if method == 'sendMessage':
+            # "⏳ ..." is the status reply, anything else is the post itself
+            if not text.startswith('⏳'):
+                self._finish(chat_id, True)
+            return self.message(chat_id, text=text)
+        if method == 'editMessageText':
+            if text.startswith('❌'):
+                self._finish(chat_id, False)
+            return self.message(chat_id, text=text)
+        return True
+
+class StubState:
+    def __init__(self, args, pages: list):
+        self.telegram = TelegramStub(args.telegram_latency / 1000)
+        self.pages = pages
+        self.amazon_latency = args.amazon_latency / 1000
+        self.amazon_errors = args.amazon_errors
+        self.amazon_captchas = args.amazon_captchas
+        self.yourls_latency = args.yourls_latency / 1000
+        self.base_url = None
+        self.amazon_requests = 0
+        self._short_ids = 0
+
+    def next_short_id(self) -> int:
+        self._short_ids += 1
+        return self._short_ids
+
+def make_handler(state: StubState):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def _send(self, status: int, body: bytes = b'', content_type: str = 'text/html; charset=utf-8', headers: dict = None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != 'HEAD':
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The bot dropped the request (a hedged attempt that lost the race)
+                    self.close_connection = True
+
+        def _params(self) -> dict:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            content_type = self.headers.get('Content-Type') or ''
+            if content_type.startswith('multipart/'):
+                return multipart_fields(body)
+            if content_type.startswith('application/json'):
+                return json.loads(body or b'{}')
+            return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+        def _handle(self):
+            parsed = urlparse(self.path)
+            host = parsed.netloc or (self.headers.get('Host') or '').split(':')[0]
+            path = parsed.path.rstrip('/')
+            if host in ('amzn.to', 'amzn.eu'):
+                asin = path.rsplit('/', 1)[-1]
+                self._send(301, headers={'Location': f"{state.base_url}/dp/{asin}"})
+            elif path.startswith(f'/bot{TOKEN}/'):
+                method = path.rsplit('/', 1)[-1]
+                result = state.telegram.call(method, self._params())
+                self._send(200, json.dumps({'ok': True, 'result': result}).encode(), 'application/json')
+            elif path.startswith('/dp/'):
+                state.amazon_requests += 1
+                if state.amazon_latency:
+                    time.sleep(state.amazon_latency * random.uniform(0.5, 1.5))
+                roll = random.random()
+                if roll < state.amazon_errors:
+                    self._send(503, b'Service Unavailable')
+                elif roll < state.amazon_errors + state.amazon_captchas:
+                    self._send(200, CAPTCHA_PAGE)
+                else:
+                    asin = path[4:].split('/')[0]
+                    self._send(200, state.pages[zlib.crc32(asin.encode()) % len(state.pages)])
+            elif path == '/yourls-api.php':
+                url = self._params().get('url', '')
+                if state.yourls_latency:
+                    time.sleep(state.yourls_latency * random.uniform(0.5, 1.5))
+                body = {'status': 'success', 'shorturl': f"{state.base_url}/y/{state.next_short_id()}", 'url': {'url': url}}
+                self._send(200, json.dumps(body).encode(), 'application/json')
+            else:
+                self._send(404, b'Not Found')
+
+        do_GET = do_POST = do_HEAD = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+def make_message(rng: random.Random, asins: list, weights: list, chats: int, args):
+    """Return (chat_id, text, expects_reply) drawn from a rough mix of real traffic."""
+    chat_id = rng.randint(1, chats)
+    roll = rng.random()
+    if roll < args.chatter:
+        return chat_id, rng.choice(CHATTER), False
+    roll -= args.chatter
+    if roll < args.batch:
+        links = ' '.join(f"https://www.amazon.it/dp/{asin}" for asin in rng.choices(asins, weights, k=rng.randint(2, 4)))
+        return chat_id, f"Offerte di oggi: {links}", True
+    roll -= args.batch
+    asin = rng.choices(asins, weights)[0]
+    if roll < args.short_links:
+        return chat_id, f"Guarda qui http://amzn.to/{asin}", True
+    return chat_id, f"https://www.amazon.it/dp/{asin}?ref_=load&th=1", True
+
+def rss_kb(pid: int):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def bot_stats(port: int):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=1) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+def run_stage(stage: int, rate: float, args, state: StubState, bot, rng, asins, weights) -> dict:
+    lags = []
+    rss_start = rss_kb(bot.pid)
+    sent = 0
+    started = time.perf_counter()
+    next_send = started
+    next_sample = started
+    end = started + args.duration
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if now >= next_send:
+            chat_id, text, expects_reply = make_message(rng, asins, weights, args.chats, args)
+            state.telegram.enqueue(chat_id, text, stage, expects_reply)
+            sent += expects_reply
+            next_send += rng.expovariate(rate)
+        if now >= next_sample:
+            stats = bot_stats(args.health_port)
+            if stats:
+                lags.append(stats['event_loop_lag']['last'])
+            next_sample += 0.5
+        time.sleep(max(0.0, min(next_send, next_sample, end) - time.perf_counter()))
+    return {
+        'stage': stage,
+        'rate': rate,
+        'sent': sent,
+        'started': started,
+        'ended': end,
+        'lags': lags,
+        'rss_start_kb': rss_start,
+        'rss_end_kb': rss_kb(bot.pid),
+    }
+
+def summarize(stages: list, results: list) -> list:
+    rows = []
+    for info in stages:
+        latencies = [latency for stage, at, latency, ok in results if stage == info['stage'] and ok]
+        errors = sum(1 for stage, at, latency, ok in results if stage == info['stage'] and not ok)
+        done_in_window = sum(1 for stage, at, latency, ok in results if info['started'] <= at < info['ended'])
+        rows.append({
+            'rate': info['rate'],
+            'sent': info['sent'],
+            'answered': len(latencies),
+            'errors': errors,
+            'lost': info['sent'] - len(latencies) - errors,
+            'throughput': done_in_window / (info['ended'] - info['started']),
+            'p50_ms': (percentile(latencies, 0.50) or 0) * 1000,
+            'p95_ms': (percentile(latencies, 0.95) or 0) * 1000,
+            'p99_ms': (percentile(latencies, 0.99) or 0) * 1000,
+            'loop_lag_p95_ms': (percentile(info['lags'], 0.95) or 0) * 1000,
+            'loop_lag_max_ms': max(info['lags'], default=0) * 1000,
+            'rss_start_kb': info['rss_start_kb'],
+            'rss_end_kb': info['rss_end_kb'],
+        })
+    return rows
+
+def print_report(rows: list, amazon_requests: int) -> None:
+    print(f"{'rate/s':>7}{'sent':>7}{'ok':>7}{'err':>6}{'lost':>6}{'done/s':>8}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'lag95':>8}{'lagmax':>8}{'RSS MB':>14}")
+    for row in rows:
+        rss = '-'
+        if row['rss_start_kb'] and row['rss_end_kb']:
+            rss = f"{row['rss_start_kb'] / 1024:.0f}->{row['rss_end_kb'] / 1024:.0f}"
+        print(f"{row['rate']:>7g}{row['sent']:>7}{row['answered']:>7}{row['errors']:>6}{row['lost']:>6}"
+              f"{row['throughput']:>8.1f}{row['p50_ms']:>9.0f}{row['p95_ms']:>9.0f}{row['p99_ms']:>9.0f}"
+              f"{row['loop_lag_p95_ms']:>8.1f}{row['loop_lag_max_ms']:>8.1f}{rss:>14}")
+    print(f"\nAmazon page requests: {amazon_requests}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='folder with saved product pages')
+    parser.add_argument('--rates', default='2,5,10,20', help='comma-separated messages per second, one stage each')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per stage')
+    parser.add_argument('--drain', type=float, default=30, help='seconds to wait for replies after the last stage')
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--products', type=int, default=500, help='distinct ASINs, picked with a long-tail popularity')
+    parser.add_argument('--chatter', type=float, default=0.2, help='share of messages without links')
+    parser.add_argument('--batch', type=float, default=0.05, help='share of messages with several links')
+    parser.add_argument('--short-links', type=float, default=0.3, help='share of single links sent as amzn.to')
+    parser.add_argument('--amazon-latency', type=float, default=300, help='ms, +-50%%')
+    parser.add_argument('--amazon-errors', type=float, default=0.0, help='share of product pages answered with 503')
+    parser.add_argument('--amazon-captchas', type=float, default=0.0, help='share of product pages answered with a captcha')
+    parser.add_argument('--yourls-latency', type=float, default=50, help='ms, +-50%%')
+    parser.add_argument('--telegram-latency', type=float, default=30, help='ms per Bot API call, +-50%%')
+    parser.add_argument('--workers', type=int, default=0, help='run the bot as BOT_MODE=frontend plus this many workers')
+    parser.add_argument('--health-port', type=int, default=18980, help='PORT given to the bot for /stats')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log', help='bot log file (default: in a temp folder)')
+    parser.add_argument('--json', dest='json_out', help='also write the report to this file')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='extra bot setting, repeatable')
+    args = parser.parse_args()
+
+    pages = load_pages(args.corpus)
+    if not pages:
+        parser.error(f"no .html pages in {args.corpus}")
+    rates = [float(rate) for rate in args.rates.split(',') if rate.strip()]
+
+    state = StubState(args, pages)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+    server.daemon_threads = True
+    state.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    work_dir = tempfile.mkdtemp(prefix='loadtest-')
+    log_path = args.log or os.path.join(work_dir, 'bot.log')
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_TOKEN': TOKEN,
+        'TELEGRAM_API_URL': state.base_url,
+        'AMAZON_BASE_URL': state.base_url,
+        'YOURLS_URL': state.base_url,
+        'PORT': str(args.health_port),
+        'STATE_DB_PATH': os.path.join(work_dir, 'state.db'),
+        'HTTP_PROXY': state.base_url,
+        'NO_PROXY': '127.0.0.1,localhost',
+        'HTTP2_ENABLED': '0',
+        'AMAZON_RATE': '1000',
+        'AMAZON_BURST': '1000',
+        'YOURLS_RATE': '1000',
+        'YOURLS_BURST': '1000',
+        'WATCH_BUDGET_PER_MINUTE': '0',
+        'SNAPSHOT_INTERVAL': '0',
+    })
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+
+    workers = []
+    with open(log_path, 'w') as log:
+        if args.workers:
+            env['BOT_MODE'] = 'frontend'
+            for index in range(args.workers):
+                worker_env = dict(env, BOT_MODE='worker', PORT=str(args.health_port + 1 + index))
+                workers.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], env=worker_env, stdout=log, stderr=subprocess.STDOUT))
+        bot = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not state.telegram.polling.wait(30) or bot.poll() is not None:
+            sys.exit(f"bot did not start polling, see {log_path}")
+        print(f"Bot polling (pid {bot.pid}), log: {log_path}")
+
+        rng = random.Random(args.seed)
+        asins = [f"B0LOAD{index:04d}" for index in range(args.products)]
+        weights = [1 / (index + 1) for index in range(args.products)]
+        stages = []
+        for stage, rate in enumerate(rates):
+            print(f"Stage {stage + 1}/{len(rates)}: {rate:g} msg/s for {args.duration:g}s")
+            stages.append(run_stage(stage, rate, args, state, bot, rng, asins, weights))
+
+        deadline = time.monotonic() + args.drain
+        while state.telegram.outstanding() and time.monotonic() < deadline:
+            time.sleep(0.2)
+        rows = summarize(stages, list(state.telegram.results))
+    finally:
+        for process in [bot] + workers:
+            process.terminate()
+        for process in [bot] + workers:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        server.shutdown()
+
+    print()
+    print_report(rows, state.amazon_requests)
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'stages': rows, 'amazon_requests': state.amazon_requests}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the scraping hot path.
+
+Serves a corpus of saved Amazon product pages and short-URL redirects from a
+local stub server (in a child process, so its CPU time is not counted) and
+measures short-URL resolution, page fetch, extraction, message building and
+the full scrape, checking the extracted fields against the expected JSON.
+
+Corpus layout:
+    <ASIN>.html       saved product page
+    <ASIN>.json       {"query": "smid=...", "fields": {...expected product fields...}}
+    redirects.json    {"<code>": "/dp/<ASIN>?..."} served as /s/<code> -> 301
+
+Usage:
+    python bench/run_bench.py --backend soup,stream -n 20
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CORPUS = os.path.join(ROOT, 'bench', 'corpus')
+
+def load_corpus(path: str):
+    pages = {}
+    expected = {}
+    redirects = {}
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if name == 'redirects.json':
+            with open(full, encoding='utf-8') as f:
+                redirects = json.load(f)
+        elif name.endswith('.html'):
+            with open(full, encoding='utf-8') as f:
+                pages[name[:-5]] = f.read()
+        elif name.endswith('.json'):
+            with open(full, encoding='utf-8') as f:
+                expected[name[:-5]] = json.load(f)
+    return pages, expected, redirects
+
+def serve_corpus(corpus: str, conn) -> None:
+    pages, expected, redirects = load_corpus(corpus)
+    page_bytes = {asin: html.encode('utf-8') for asin, html in pages.items()}
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def _respond(self, with_body: bool):
+            path = self.path.split('?', 1)[0].rstrip('/')
+            if path.startswith('/s/') and path[3:] in redirects:
+                self.send_response(301)
+                self.send_header('Location', redirects[path[3:]])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if path.startswith('/dp/') and path[4:] in page_bytes:
+                body = page_bytes[path[4:]]
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(body)
+                return
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self):
+            self._respond(True)
+
+        def do_HEAD(self):
+            self._respond(False)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+class Stage:
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = []
+        self.cpu = 0.0
+        self.peak_bytes = None
+
+    def add(self, wall: float, cpu: float) -> None:
+        self.wall.append(wall)
+        self.cpu += cpu
+
+    def row(self) -> dict:
+        if not self.wall:
+            return {'stage': self.name, 'runs': 0}
+        wall = sorted(self.wall)
+        total = sum(wall)
+        return {
+            'stage': self.name,
+            'runs': len(wall),
+            'wall_mean_ms': total / len(wall) * 1000,
+            'wall_p95_ms': wall[math.ceil(len(wall) * 0.95) - 1] * 1000,
+            'cpu_mean_ms': self.cpu / len(wall) * 1000,
+            'per_sec': len(wall) / total if total else None,
+            'peak_kb': self.peak_bytes / 1024 if self.peak_bytes is not None else None,
+        }
+
+async def timed(stage: Stage, coro_or_fn, *args):
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    if asyncio.iscoroutinefunction(coro_or_fn):
+        result = await coro_or_fn(*args)
+    else:
+        result = coro_or_fn(*args)
+    stage.add(time.perf_counter() - wall_start, time.process_time() - cpu_start)
+    return result
+
+def compare_fields(expected: dict, actual: dict) -> list:
+    return [
+        (field, value, actual.get(field))
+        for field, value in expected.items()
+        if actual.get(field) != value
+    ]
+
+async def run_benchmark(main, base_url: str, pages: dict, expected: dict, redirects: dict,
+                        backends: list, iterations: int) -> dict:
+    stages = {}
+    mismatches = []
+
+    def stage(name: str) -> Stage:
+        if name not in stages:
+            stages[name] = Stage(name)
+        return stages[name]
+
+    for _ in range(iterations):
+        for code, target in redirects.items():
+            resolved = await timed(stage('resolve'), main.resolve_short_url, f"{base_url}/s/{code}")
+            if main.extract_asin_from_url(resolved) != main.extract_asin_from_url(target):
+                mismatches.append({'redirect': code, 'expected': target, 'actual': resolved})
+
+    client = main.get_amazon_client()
+    urls = {}
+    for asin in pages:
+        query = expected.get(asin, {}).get('query', '')
+        urls[asin] = main.normalize_amazon_url(f"{base_url}/dp/{asin}" + (f"?{query}" if query else ''))
+
+    for _ in range(iterations):
+        for asin, url in urls.items():
+            response = await timed(stage('fetch'), client.get, url)
+            response.raise_for_status()
+
+    for backend in backends:
+        extractor = main.PRODUCT_EXTRACTORS[backend]
+        parse_stage = stage(f'parse[{backend}]')
+        message_stage = stage(f'message[{backend}]')
+        for _ in range(iterations):
+            for asin, url in urls.items():
+                product_info = await timed(parse_stage, extractor, pages[asin], url)
+                await timed(message_stage, main.build_product_message, product_info, f"{base_url}/s/x", 'Bench')
+
+        tracemalloc.start()
+        for asin, url in urls.items():
+            product_info = extractor(pages[asin], url)
+            if asin in expected:
+                for field, want, got in compare_fields(expected[asin].get('fields', {}), product_info.to_dict()):
+                    mismatches.append({'backend': backend, 'asin': asin, 'field': field, 'expected': want, 'actual': got})
+        parse_stage.peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        main.HTML_EXTRACTOR = backend
+        scrape_stage = stage(f'scrape[{backend}]')
+        for _ in range(iterations):
+            for asin, url in urls.items():
+                product_info = await timed(scrape_stage, main.scrape_product, url)
+                if not product_info.found:
+                    mismatches.append({'backend': backend, 'asin': asin, 'field': 'scrape', 'expected': 'product', 'actual': None})
+
+    await main.close_http_clients()
+    main.shutdown_parse_pool()
+    return {
+        'pages': len(pages),
+        'iterations': iterations,
+        'stages': [s.row() for s in stages.values()],
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'mismatches': mismatches,
+    }
+
+def print_report(report: dict) -> None:
+    print(f"Pages: {report['pages']}  Iterations: {report['iterations']}  Max RSS: {report['max_rss_kb']} KB")
+    print(f"{'stage':<20}{'runs':>6}{'wall ms':>10}{'p95 ms':>10}{'cpu ms':>10}{'per sec':>10}{'peak KB':>10}")
+    for row in report['stages']:
+        if not row['runs']:
+            continue
+        peak = f"{row['peak_kb']:.0f}" if row['peak_kb'] is not None else '-'
+        per_sec = f"{row['per_sec']:.1f}" if row['per_sec'] else '-'
+        print(f"{row['stage']:<20}{row['runs']:>6}{row['wall_mean_ms']:>10.2f}{row['wall_p95_ms']:>10.2f}"
+              f"{row['cpu_mean_ms']:>10.2f}{per_sec:>10}{peak:>10}")
+    if report['mismatches']:
+        print(f"\n{len(report['mismatches'])} mismatch(es):")
+        for mismatch in report['mismatches']:
+            print(f"  {json.dumps(mismatch, ensure_ascii=False)}")
+    else:
+        print("\nAll fields match the expected JSON")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='folder with saved pages and expected JSON')
+    parser.add_argument('--backend', default='soup,stream', help='comma-separated extractors to compare')
+    parser.add_argument('-n', '--iterations', type=int, default=10)
+    parser.add_argument('--parse-pool', default='none', help='PARSE_POOL used by the scrape stage')
+    parser.add_argument('--json', dest='json_out', help='also write the report to this file')
+    args = parser.parse_args()
+
+    pages, expected, redirects = load_corpus(args.corpus)
+    if not pages:
+        parser.error(f"no .html pages in {args.corpus}")
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    stub = multiprocessing.Process(target=serve_corpus, args=(args.corpus, child_conn), daemon=True)
+    stub.start()
+    base_url = f"http://127.0.0.1:{parent_conn.recv()}"
+
+    state_dir = tempfile.mkdtemp(prefix='bench-')
+    os.environ.setdefault('TELEGRAM_TOKEN', 'bench:token')
+    os.environ['AMAZON_BASE_URL'] = base_url
+    os.environ['STATE_DB_PATH'] = os.path.join(state_dir, 'state.db')
+    os.environ['PARSE_POOL'] = args.parse_pool
+    os.environ['HEDGE_DELAY'] = os.environ.get('HEDGE_DELAY', '5')
+    # scrape[stream] goes through the streaming fetch, early termination included
+    os.environ.setdefault('STREAM_FETCH', '1')
+    os.environ.setdefault('AMAZON_RATE', '100000')
+    os.environ.setdefault('AMAZON_BURST', '100000')
+    sys.path.insert(0, ROOT)
+    import main as bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        report = asyncio.run(run_benchmark(
+            bot, base_url, pages, expected, redirects,
+            [b.strip() for b in args.backend.split(',') if b.strip()],
+            args.iterations,
+        ))
+    finally:
+        stub.terminate()
+
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if report['mismatches'] else 0)
+
+if __name__ == '__main__':
+    main()
@@ -3,44 +3,170 @@
 Amazon Affiliate Bot for Telegram
 """
 
+from __future__ import annotations
+
 import os
 import logging
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import threading
 import re
 import json
-from urllib.parse import urlencode, parse_qs, urlparse
-from telegram import Update
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    filters,
-    ContextTypes,
-)
-import httpx
-from bs4 import BeautifulSoup
+import time
+import asyncio
+import contextvars
+import random
+import sqlite3
+import signal
+import hashlib
+import importlib.util
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from typing import TYPE_CHECKING
+from urllib.parse import urlencode, parse_qs, urlparse, urljoin
+
+# telegram, httpx and bs4 are imported where they are first needed, so the
+# health server (and the spawned parse workers) come up without paying for them.
+if TYPE_CHECKING:
+    import httpx
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
+
+# Trace of the request being handled by the current task (see start_trace)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace = current_trace.get()
+        record.trace_id = trace.trace_id if trace is not None else '-'
+        return True
 
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s",
     level=logging.INFO,
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(TraceIdFilter())
 logger = logging.getLogger(__name__)
 
+# Parse workers (PARSE_POOL=process) import this module in a spawned child;
+# they only parse pages, so the start-up side effects below are skipped there.
+# The child's name is set before it imports __main__, parent_process() is not.
+IN_PARSE_WORKER = multiprocessing.current_process().name != 'MainProcess'
+
+def _process_start_time() -> float:
+    """Monotonic time of exec, so interpreter start-up and imports are counted too."""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.monotonic() - (uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+PROCESS_STARTED = _process_start_time()
+STARTUP_REPORT = os.environ.get("STARTUP_REPORT", "0") == "1"
+startup_times = {}
+
+def mark_startup(milestone: str) -> None:
+    """Record the first time a start-up milestone is reached, in seconds since exec."""
+    if milestone in startup_times:
+        return
+    startup_times[milestone] = round(time.monotonic() - PROCESS_STARTED, 3)
+    if STARTUP_REPORT:
+        logger.info("Startup: %s after %.3fs", milestone, startup_times[milestone])
+
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 YOURLS_URL = os.environ.get("YOURLS_URL", "https://url.nelloonrender.duckdns.org")
 YOURLS_SIGNATURE = os.environ.get("YOURLS_SIGNATURE", "def05e4247")
 AFFILIATE_TAG = os.environ.get("AFFILIATE_TAG", "ruciferia-21")
 PORT = int(os.environ.get("PORT", 10000))
+AMAZON_BASE_URL = os.environ.get("AMAZON_BASE_URL", "https://www.amazon.it").rstrip('/')
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 30.0))
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "1") == "1"
+PRODUCT_CACHE_MAX_ENTRIES = int(os.environ.get("PRODUCT_CACHE_MAX_ENTRIES", 20000))
+PRODUCT_CACHE_MAX_BYTES = int(os.environ.get("PRODUCT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+PRODUCT_CACHE_FAST_TTL = float(os.environ.get("PRODUCT_CACHE_FAST_TTL", 900))
+PRODUCT_CACHE_STALE_TTL = float(os.environ.get("PRODUCT_CACHE_STALE_TTL", 3600))
+PRODUCT_CACHE_SLOW_TTL = float(os.environ.get("PRODUCT_CACHE_SLOW_TTL", 86400))
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "bot_state.db")
+HTML_EXTRACTOR = os.environ.get("HTML_EXTRACTOR", "stream")
+PARSE_POOL = os.environ.get("PARSE_POOL", "process")
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", 2))
+PARSE_QUEUE_SIZE = int(os.environ.get("PARSE_QUEUE_SIZE", 8))
+STREAM_FETCH = os.environ.get("STREAM_FETCH", "0") == "1"
+STREAM_OPTIONAL_BUDGET = int(os.environ.get("STREAM_OPTIONAL_BUDGET", 256 * 1024))
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", 64))
+SCRAPE_CONCURRENCY = int(os.environ.get("SCRAPE_CONCURRENCY", 4))
+UA_STRATEGY = os.environ.get("UA_STRATEGY", "hedged")
+HEDGE_DELAY = os.environ.get("HEDGE_DELAY", "auto")
+AMAZON_RATE = float(os.environ.get("AMAZON_RATE", 2.0))
+AMAZON_BURST = int(os.environ.get("AMAZON_BURST", 5))
+YOURLS_RATE = float(os.environ.get("YOURLS_RATE", 5.0))
+YOURLS_BURST = int(os.environ.get("YOURLS_BURST", 10))
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_RESET = float(os.environ.get("BREAKER_RESET", 30.0))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip('/')
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+BATCH_MAX_LINKS = int(os.environ.get("BATCH_MAX_LINKS", 30))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 5))
+BATCH_REPLY_MODE = os.environ.get("BATCH_REPLY_MODE", "post")
+WATCH_BUDGET_PER_MINUTE = float(os.environ.get("WATCH_BUDGET_PER_MINUTE", 20))
+WATCH_MIN_INTERVAL = float(os.environ.get("WATCH_MIN_INTERVAL", 3600))
+WATCH_MAX_INTERVAL = float(os.environ.get("WATCH_MAX_INTERVAL", 7 * 86400))
+WATCH_JITTER = float(os.environ.get("WATCH_JITTER", 0.2))
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", 300))
+PHOTO_CACHE_MAX_ENTRIES = int(os.environ.get("PHOTO_CACHE_MAX_ENTRIES", 5000))
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 300))
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.05))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 3000))
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+TRACE_DUMP_DIR = os.environ.get("TRACE_DUMP_DIR", "")
+# Bot API server other than api.telegram.org (a local Bot API server, or the load-test stub)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip('/')
+# all: one process does everything; frontend: receives updates and queues link jobs; worker: runs queued jobs
+BOT_MODE = os.environ.get("BOT_MODE", "all")
+JOB_QUEUE_URL = os.environ.get("JOB_QUEUE_URL", "")
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", 5))
+JOB_LEASE = float(os.environ.get("JOB_LEASE", 120))
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 4))
 
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_TOKEN not set")
+if BOT_MODE not in ('all', 'frontend', 'worker'):
+    raise ValueError(f"BOT_MODE must be all, frontend or worker, not {BOT_MODE!r}")
+if not WEBHOOK_SECRET:
+    # Stable across restarts, so Telegram keeps the webhook valid
+    WEBHOOK_SECRET = hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()[:32]
+
+if not IN_PARSE_WORKER:
+    logger.info("Bot Configuration:")
+    logger.info("  TELEGRAM_TOKEN: %s...", TELEGRAM_TOKEN[:10])
+    logger.info("  YOURLS_URL: %s", YOURLS_URL)
+    logger.info("  AFFILIATE_TAG: %s", AFFILIATE_TAG)
+    logger.info("  PORT: %s", PORT)
+    logger.info("  BOT_MODE: %s", BOT_MODE)
+    
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        if HTTP2_ENABLED:
+            logger.warning("h2 not installed - HTTP/2 disabled")
+        HTTP2_ENABLED = False
 
-logger.info(f"Bot Configuration:")
-logger.info(f"  TELEGRAM_TOKEN: {TELEGRAM_TOKEN[:10]}...")
-logger.info(f"  YOURLS_URL: {YOURLS_URL}")
-logger.info(f"  AFFILIATE_TAG: {AFFILIATE_TAG}")
-logger.info(f"  PORT: {PORT}")
+# Advertise only the encodings httpx can decode in this install
+ACCEPT_ENCODING = 'gzip, deflate'
+if importlib.util.find_spec('brotli') or importlib.util.find_spec('brotlicffi'):
+    ACCEPT_ENCODING += ', br'
 
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -48,59 +174,1195 @@ USER_AGENTS = [
     'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
 ]
 
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Bot is running')
-    
-    def log_message(self, format, *args):
+# Precompiled once: these run for every message and every scraped page
+URL_RE = re.compile(r'https?://[^\s\)\]]+')
+PRODUCT_PATH_RE = re.compile(r'/(?:dp|gp/product)/[A-Z0-9]{10}')
+ASIN_PATTERNS = (
+    re.compile(r'/dp/([A-Z0-9]{10})'),
+    re.compile(r'/gp/product/([A-Z0-9]{10})'),
+    re.compile(r'/d/([A-F0-9]+)'),
+)
+ASIN_QUERY_RE = re.compile(r'^\s*([A-Z0-9]{10})\s*$')
+PRICE_TOKEN_RE = re.compile(r'[\d.,€\$]+')
+RATING_RE = re.compile(r'[\d,]+')
+REVIEWS_RE = re.compile(r'[\d.]+')
+COUPON_CLASS_RE = re.compile('coupon|promotion-badge', re.I)
+PRICE_SUFFIX_RE = re.compile(r'€.*')
+TAG_PARAM_RE = re.compile(r'[?&]tag=[^&]*')
+PROMO_PATTERNS = (
+    re.compile(r'(\d+(?:[.,]\d{2})?€)'),
+    re.compile(r'(\d+%)'),
+    re.compile(r'(Mediano:)'),
+)
+PROMO_PRICE_PAIR_RE = re.compile(r'(\d+(?:[.,]\d{2})?€)\s*(\d+(?:[.,]\d{2})?€)')
+
+DEFAULT_PRODUCT_TITLE = 'Prodotto Amazon'
+
+@dataclass(frozen=True, slots=True)
+class ProductInfo:
+    """Scraped product fields; packs to a plain tuple for caches and worker IPC."""
+
+    title: str = DEFAULT_PRODUCT_TITLE
+    price: str = None
+    rating: str = None
+    reviews: str = None
+    image: str = None
+    description: str = None
+    condition_status: str = None
+    promotion: str = None
+    coupon: str = None
+    # Amazon could not be read at all (errors, captcha, open circuit), as
+    # opposed to a page without product data: worth trying again later
+    unavailable: bool = False
+
+    @property
+    def found(self) -> bool:
+        return bool(self.title) and self.title != DEFAULT_PRODUCT_TITLE
+
+    def pack(self) -> tuple:
+        return (self.title, self.price, self.rating, self.reviews, self.image,
+                self.description, self.condition_status, self.promotion, self.coupon,
+                self.unavailable)
+
+    @classmethod
+    def unpack(cls, packed) -> 'ProductInfo':
+        return cls(*packed)
+
+    def to_dict(self) -> dict:
+        return dict(zip(PRODUCT_FIELDS, self.pack()))
+
+    def without_fast_fields(self) -> 'ProductInfo':
+        return replace(self, **{field: None for field in FAST_PRODUCT_FIELDS})
+
+PRODUCT_FIELDS = tuple(field.name for field in fields(ProductInfo))
+
+# Fields that change often (price, deals) expire after PRODUCT_CACHE_FAST_TTL,
+# everything else (title, image, description, rating) after PRODUCT_CACHE_SLOW_TTL.
+FAST_PRODUCT_FIELDS = ('price', 'coupon', 'promotion')
+
+def packed_size(key: str, packed: tuple) -> int:
+    """Approximate memory held by a cache entry."""
+    return sys.getsizeof(key) + sys.getsizeof(packed) + sum(sys.getsizeof(value) for value in packed if value is not None)
+
+class ProductCache:
+    def __init__(self, max_entries: int, max_bytes: int, fast_ttl: float, stale_ttl: float, slow_ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.fast_ttl = fast_ttl
+        self.stale_ttl = stale_ttl
+        self.slow_ttl = slow_ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+    def get(self, key: str):
+        """Return (product_info, is_stale) or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            packed, stored_at, size = entry
+            age = time.monotonic() - stored_at
+            if age > self.slow_ttl:
+                self._remove(key)
+                self.misses += 1
+                return None
+            if age > self.fast_ttl + self.stale_ttl:
+                # Price is too old to show even while revalidating
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if age > self.fast_ttl:
+                self.stale_hits += 1
+                return ProductInfo.unpack(packed), True
+            self.hits += 1
+            return ProductInfo.unpack(packed), False
+
+    def get_fallback(self, key: str):
+        """Return the slow fields of an entry whose price has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            packed, stored_at, size = entry
+            if time.monotonic() - stored_at > self.slow_ttl:
+                return None
+            return ProductInfo.unpack(packed).without_fast_fields()
+
+    def put(self, key: str, product_info: ProductInfo) -> None:
+        packed = product_info.pack()
+        size = packed_size(key, packed)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (packed, time.monotonic(), size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        packed, stored_at, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def snapshot(self) -> list:
+        """Return (key, packed, age) for every entry, least recently used first."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, packed, now - stored_at) for key, (packed, stored_at, size) in self._entries.items()]
+
+    def restore(self, entries) -> int:
+        """Load (key, packed, age) entries saved by snapshot(), keeping their age."""
+        now = time.monotonic()
+        restored = 0
+        with self._lock:
+            for key, packed, age in entries:
+                if age > self.slow_ttl or key in self._entries:
+                    continue
+                packed = tuple(packed)
+                size = packed_size(key, packed)
+                self._entries[key] = (packed, now - age, size)
+                self._bytes += size
+                restored += 1
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+        return restored
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'refreshes': self.refreshes,
+            }
+
+product_cache = ProductCache(
+    max_entries=PRODUCT_CACHE_MAX_ENTRIES,
+    max_bytes=PRODUCT_CACHE_MAX_BYTES,
+    fast_ttl=PRODUCT_CACHE_FAST_TTL,
+    stale_ttl=PRODUCT_CACHE_STALE_TTL,
+    slow_ttl=PRODUCT_CACHE_SLOW_TTL,
+)
+
+_state_db = None
+_state_db_lock = threading.Lock()
+
+def get_state_db() -> sqlite3.Connection:
+    global _state_db
+    with _state_db_lock:
+        if _state_db is None:
+            _state_db = sqlite3.connect(STATE_DB_PATH, check_same_thread=False, isolation_level=None)
+            _state_db.execute('PRAGMA journal_mode=WAL')
+            _state_db.execute('PRAGMA synchronous=NORMAL')
+            logger.info("State database opened: %s", STATE_DB_PATH)
+        return _state_db
+
+class PersistentMap:
+    """String-to-string map stored in a table of the bot's SQLite state DB.
+
+    With max_entries, the oldest keys are pruned once the table outgrows it.
+    """
+
+    def __init__(self, table: str, max_entries: int = None):
+        self.table = table
+        self.max_entries = max_entries
+        self._ready = False
+        self._writes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        db = get_state_db()
+        if not self._ready:
+            with _state_db_lock:
+                db.execute(
+                    f'CREATE TABLE IF NOT EXISTS {self.table} '
+                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)'
+                )
+            self._ready = True
+        return db
+
+    def get(self, key: str):
+        db = self._db()
+        with _state_db_lock:
+            row = db.execute(f'SELECT value FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        db = self._db()
+        with _state_db_lock:
+            db.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, updated_at) VALUES (?, ?, ?)',
+                (key, value, time.time()),
+            )
+            self._writes += 1
+            # Prune in steps so most writes stay a single insert
+            if self.max_entries and self._writes % 100 == 0:
+                db.execute(
+                    f'DELETE FROM {self.table} WHERE key IN '
+                    f'(SELECT key FROM {self.table} ORDER BY updated_at DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,),
+                )
+
+    def delete(self, key: str) -> None:
+        db = self._db()
+        with _state_db_lock:
+            db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def __len__(self) -> int:
+        db = self._db()
+        with _state_db_lock:
+            return db.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+short_link_memo = PersistentMap('short_links')
+resolved_url_cache = PersistentMap('resolved_urls')
+# Telegram file_id of each product image already uploaded once, keyed by image URL
+photo_file_ids = PersistentMap('photo_file_ids', max_entries=PHOTO_CACHE_MAX_ENTRIES)
+
+class Watchlist:
+    """Products watched per chat, with the fields last posted and the next check time.
+
+    A product added by /watch has no fields yet (awaiting_baseline): its first
+    check, made by the scheduler within the watch budget, only records them.
+    """
+
+    def __init__(self, table: str = 'watchlist'):
+        self.table = table
+        self._ready = False
+
+    def _db(self) -> sqlite3.Connection:
+        db = get_state_db()
+        if not self._ready:
+            with _state_db_lock:
+                db.execute(
+                    f'CREATE TABLE IF NOT EXISTS {self.table} '
+                    '(chat_id INTEGER NOT NULL, asin TEXT NOT NULL, url TEXT NOT NULL, '
+                    'price TEXT, coupon TEXT, promotion TEXT, '
+                    'interval REAL NOT NULL, next_check REAL NOT NULL, '
+                    'awaiting_baseline INTEGER NOT NULL DEFAULT 1, '
+                    'PRIMARY KEY (chat_id, asin))'
+                )
+                db.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_next_check ON {self.table} (next_check)')
+            self._ready = True
+        return db
+
+    def add(self, chat_id: int, asin: str, url: str, next_check: float) -> bool:
+        """Start watching a product; False if the chat already watches it."""
+        db = self._db()
+        with _state_db_lock:
+            return db.execute(
+                f'INSERT OR IGNORE INTO {self.table} (chat_id, asin, url, interval, next_check) VALUES (?, ?, ?, ?, ?)',
+                (chat_id, asin, url, WATCH_MIN_INTERVAL, next_check),
+            ).rowcount > 0
+
+    def remove(self, chat_id: int, asin: str) -> bool:
+        db = self._db()
+        with _state_db_lock:
+            return db.execute(f'DELETE FROM {self.table} WHERE chat_id = ? AND asin = ?', (chat_id, asin)).rowcount > 0
+
+    def next_due(self, now: float):
+        """Return the most overdue row as a dict, or None."""
+        db = self._db()
+        with _state_db_lock:
+            row = db.execute(
+                f'SELECT chat_id, asin, url, price, coupon, promotion, interval, awaiting_baseline FROM {self.table} '
+                'WHERE next_check <= ? ORDER BY next_check LIMIT 1',
+                (now,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('chat_id', 'asin', 'url', 'price', 'coupon', 'promotion', 'interval', 'awaiting_baseline'), row))
+
+    def reschedule(self, chat_id: int, asin: str, interval: float, next_check: float, product_info: ProductInfo = None) -> None:
+        db = self._db()
+        with _state_db_lock:
+            if product_info is None:
+                db.execute(
+                    f'UPDATE {self.table} SET interval = ?, next_check = ? WHERE chat_id = ? AND asin = ?',
+                    (interval, next_check, chat_id, asin),
+                )
+            else:
+                db.execute(
+                    f'UPDATE {self.table} SET price = ?, coupon = ?, promotion = ?, interval = ?, next_check = ?, '
+                    'awaiting_baseline = 0 WHERE chat_id = ? AND asin = ?',
+                    (product_info.price, product_info.coupon, product_info.promotion, interval, next_check, chat_id, asin),
+                )
+
+    def count(self, chat_id: int = None) -> int:
+        db = self._db()
+        with _state_db_lock:
+            if chat_id is None:
+                return db.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+            return db.execute(f'SELECT COUNT(*) FROM {self.table} WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+
+watchlist = Watchlist()
+
+# Finished jobs are remembered this long, so a message delivered twice is queued once
+JOB_KEEP_SECONDS = 3600
+JOB_POLL_INTERVAL = 0.5
+
+class SqliteJobQueue:
+    """Link jobs in a table of the SQLite state DB, shared by the bot processes of one machine.
+
+    Claiming a job leases it for JOB_LEASE seconds; if its worker dies, the
+    job becomes available again when the lease runs out.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, table: str = 'link_jobs'):
+        self.table = table
+        self._ready = False
+        self._writes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        db = get_state_db()
+        if not self._ready:
+            with _state_db_lock:
+                db.execute(
+                    f'CREATE TABLE IF NOT EXISTS {self.table} '
+                    '(key TEXT PRIMARY KEY, job TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL, '
+                    'available_at REAL NOT NULL, created_at REAL NOT NULL)'
+                )
+                db.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_available ON {self.table} (state, available_at)')
+            self._ready = True
+        return db
+
+    async def enqueue(self, key: str, job: dict) -> bool:
+        """Queue a job; False if the same key was queued in the last JOB_KEEP_SECONDS."""
+        db = self._db()
+        now = time.time()
+        with _state_db_lock:
+            self._writes += 1
+            if self._writes % 100 == 0:
+                db.execute(
+                    f"DELETE FROM {self.table} WHERE state IN ('done', 'failed') AND created_at < ?",
+                    (now - JOB_KEEP_SECONDS,),
+                )
+            return db.execute(
+                f"INSERT OR IGNORE INTO {self.table} (key, job, state, attempts, available_at, created_at) "
+                "VALUES (?, ?, 'queued', 0, ?, ?)",
+                (key, json.dumps(job, ensure_ascii=False), now, now),
+            ).rowcount > 0
+
+    async def claim(self):
+        """Lease the job that has waited longest; returns (key, job, attempt) or None."""
+        db = self._db()
+        now = time.time()
+        with _state_db_lock:
+            # One statement, so two processes can never lease the same job;
+            # fetchall() finishes it and releases the write lock at once
+            rows = db.execute(
+                f"UPDATE {self.table} SET state = 'running', attempts = attempts + 1, available_at = ? "
+                f"WHERE key = (SELECT key FROM {self.table} WHERE state IN ('queued', 'running') "
+                "AND available_at <= ? ORDER BY available_at LIMIT 1) RETURNING key, job, attempts",
+                (now + JOB_LEASE, now),
+            ).fetchall()
+        if not rows:
+            return None
+        key, job, attempts = rows[0]
+        return key, json.loads(job), attempts
+
+    def _update(self, sql: str, params: tuple) -> None:
+        db = self._db()
+        with _state_db_lock:
+            db.execute(f'UPDATE {self.table} SET {sql} WHERE key = ?', params)
+
+    async def complete(self, key: str) -> None:
+        self._update("state = 'done'", (key,))
+
+    async def fail(self, key: str) -> None:
+        self._update("state = 'failed'", (key,))
+
+    async def retry(self, key: str, delay: float) -> None:
+        self._update("state = 'queued', available_at = ?", (time.time() + delay, key))
+
+    async def release(self, key: str) -> None:
+        """Give back a job this worker did not get to finish, without counting the attempt."""
+        self._update("state = 'queued', attempts = attempts - 1, available_at = ?", (time.time(), key))
+
+class RedisJobQueue:
+    """Link jobs in Redis (or a compatible server), shared by bot processes on any machine.
+
+    Same leasing as SqliteJobQueue: a sorted set holds each job scored by
+    the time it becomes available, and claiming it pushes the score past the lease.
+    """
+
+    name = 'redis'
+    CLAIM_SCRIPT = """
+local key = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)[1]
+if not key then return false end
+local job = redis.call('HGET', KEYS[2], key)
+if not job then
+    redis.call('ZREM', KEYS[1], key)
+    return false
+end
+redis.call('ZADD', KEYS[1], ARGV[2], key)
+return {key, job, redis.call('HINCRBY', KEYS[3], key, 1)}
+"""
+
+    def __init__(self, url: str, prefix: str = 'amazon-bot:jobs'):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("JOB_QUEUE_URL points to Redis but the redis package is not installed") from None
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._due = f'{prefix}:due'
+        self._jobs = f'{prefix}:data'
+        self._attempts = f'{prefix}:attempts'
+        self._seen = f'{prefix}:seen:'
+        self._claim = self._redis.register_script(self.CLAIM_SCRIPT)
+
+    async def enqueue(self, key: str, job: dict) -> bool:
+        if not await self._redis.set(self._seen + key, 1, nx=True, ex=JOB_KEEP_SECONDS):
+            return False
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._jobs, key, json.dumps(job, ensure_ascii=False))
+            pipe.zadd(self._due, {key: time.time()})
+            await pipe.execute()
+        return True
+
+    async def claim(self):
+        now = time.time()
+        row = await self._claim(keys=[self._due, self._jobs, self._attempts], args=[now, now + JOB_LEASE])
+        if not row:
+            return None
+        key, job, attempts = row
+        return key, json.loads(job), int(attempts)
+
+    async def complete(self, key: str) -> None:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._due, key)
+            pipe.hdel(self._jobs, key)
+            pipe.hdel(self._attempts, key)
+            await pipe.execute()
+
+    async def fail(self, key: str) -> None:
+        await self.complete(key)
+
+    async def retry(self, key: str, delay: float) -> None:
+        await self._redis.zadd(self._due, {key: time.time() + delay})
+
+    async def release(self, key: str) -> None:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self._due, {key: time.time()})
+            pipe.hincrby(self._attempts, key, -1)
+            await pipe.execute()
+
+_job_queue = None
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        if JOB_QUEUE_URL.startswith(('redis://', 'rediss://', 'unix://')):
+            _job_queue = RedisJobQueue(JOB_QUEUE_URL)
+        elif JOB_QUEUE_URL in ('', 'sqlite'):
+            _job_queue = SqliteJobQueue()
+        else:
+            raise ValueError(f"Unsupported JOB_QUEUE_URL: {JOB_QUEUE_URL}")
+        logger.info("Job queue: %s", _job_queue.name)
+    return _job_queue
+
+job_stats = {'enqueued': 0, 'duplicates': 0, 'running': 0, 'done': 0, 'retried': 0, 'failed': 0}
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0)
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    inner = ','.join(f'{k}="{str(v)}"' for k, v in labels.items())
+    return '{' + inner + '}'
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(dict(zip(self.label_names, label_values)))} {value}")
+        return lines
+
+class Gauge:
+    """Gauge whose samples are read from a callback when /metrics is scraped."""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, help_text: str, label_name: str, collect):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.collect = collect
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_value, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels({self.label_name: label_value})} {value}")
+        return lines
+
+class CollectedCounter(Gauge):
+    """Counter whose totals are kept elsewhere and read when /metrics is scraped."""
+
+    metric_type = 'counter'
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *label_values, value: float) -> None:
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._series.items()):
+                labels = dict(zip(self.label_names, label_values))
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+STAGE_SECONDS = Histogram('bot_stage_seconds', 'Time spent in each stage of handle_url', ('stage',))
+UA_RETRIES = Counter('bot_user_agent_retries_total', 'Extra User-Agent requests started after the first one', ('upstream',))
+UPSTREAM_ERRORS = Counter('bot_upstream_errors_total', 'Non-200 statuses and request errors from upstreams', ('upstream', 'status'))
+YOURLS_FALLBACKS = Counter('bot_yourls_fallbacks_total', 'Messages sent with the long affiliate URL because YOURLS failed', ('reason',))
+COALESCED_REQUESTS = Counter('bot_coalesced_requests_total', 'Lookups that joined an identical request already in flight', ('kind',))
+PHOTO_SEND_FAILURES = Counter('bot_photo_send_failures_total', 'send_photo calls that failed and fell back to text')
+INLINE_ANSWERS = Counter('bot_inline_answers_total', 'Inline queries answered, by kind of result', ('result',))
+PHOTO_SOURCES = Counter('bot_photo_sends_total', 'Product photos sent, by how the image reached Telegram', ('source',))
+WATCH_CHECKS = Counter('bot_watch_checks_total', 'Watched products re-checked by the price-watch scheduler', ('result',))
+IN_FLIGHT = Gauge('bot_in_flight', 'Work currently in progress', 'kind', lambda: {
+    'handle_url': handle_url_stats['in_flight'],
+    'scrape': scrape_stats['in_flight'],
+    'scrape_waiting': scrape_stats['waiting'],
+    'parse': parse_stats['in_flight'],
+    'parse_waiting': parse_stats['waiting'],
+})
+UPSTREAM_RATE = Gauge('bot_upstream_rate', 'Current request rate allowed by the adaptive limiter (req/s)', 'upstream', lambda: {
+    'amazon': amazon_limiter.rate,
+    'yourls': yourls_limiter.rate,
+})
+CIRCUIT_OPEN = Gauge('bot_circuit_open', '1 while the upstream circuit breaker is not closed', 'upstream', lambda: {
+    'amazon': int(amazon_breaker.state != 'closed'),
+    'yourls': int(yourls_breaker.state != 'closed'),
+})
+LOOP_LAG_GAUGE = Gauge('bot_event_loop_lag_seconds', 'How late the bot event loop wakes up a sleeping task', 'stat', lambda: loop_lag_stats())
+STARTUP_GAUGE = Gauge('bot_startup_seconds', 'Seconds from process start to each start-up milestone', 'milestone', lambda: startup_times)
+JOB_GAUGE = Gauge('bot_jobs', 'Link jobs queued by the front-end and run by workers', 'stat', lambda: job_stats)
+PRODUCT_CACHE_GAUGE = Gauge('bot_product_cache', 'Product cache size', 'metric', lambda: {
+    key: value for key, value in product_cache.stats().items() if key in ('entries', 'bytes')
+})
+PRODUCT_CACHE_EVENTS = CollectedCounter('bot_product_cache_events_total', 'Product cache lookups, refreshes and evictions', 'event', lambda: {
+    key: value for key, value in product_cache.stats().items() if key not in ('entries', 'bytes')
+})
+METRICS = [
+    STAGE_SECONDS, UA_RETRIES, UPSTREAM_ERRORS, YOURLS_FALLBACKS, COALESCED_REQUESTS,
+    PHOTO_SEND_FAILURES, PHOTO_SOURCES, INLINE_ANSWERS, WATCH_CHECKS, IN_FLIGHT, UPSTREAM_RATE, CIRCUIT_OPEN, LOOP_LAG_GAUGE, STARTUP_GAUGE, JOB_GAUGE, PRODUCT_CACHE_GAUGE,
+    PRODUCT_CACHE_EVENTS,
+]
+handle_url_stats = {'in_flight': 0}
+
+trace_logger = logging.getLogger(f"{__name__}.trace")
+if TRACE_FILE and not IN_PARSE_WORKER:
+    _trace_handler = logging.FileHandler(TRACE_FILE)
+    _trace_handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(_trace_handler)
+    trace_logger.propagate = False
+
+class Trace:
+    """Timed spans and events of one request, written as a single JSON line."""
+
+    __slots__ = ('trace_id', 'kind', 'attrs', 'started', 'spans', 'events', 'ok', 'pages')
+
+    def __init__(self, kind: str, attrs: dict):
+        self.trace_id = os.urandom(6).hex()
+        self.kind = kind
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.spans = []
+        self.events = []
+        self.ok = True
+        self.pages = []
+
+    def add_span(self, name: str, started: float, elapsed: float, ok: bool) -> None:
+        self.spans.append({
+            'name': name,
+            'start_ms': round((started - self.started) * 1000, 2),
+            'ms': round(elapsed * 1000, 2),
+            'ok': ok,
+        })
+
+    def to_dict(self, total: float) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'kind': self.kind,
+            'ok': self.ok,
+            'total_ms': round(total * 1000, 2),
+            **self.attrs,
+            'spans': self.spans,
+            'events': self.events,
+        }
+
+@contextmanager
+def start_trace(kind: str, **attrs):
+    trace = Trace(kind, attrs)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.ok = False
+        trace.events.append({'name': 'exception', 'error': type(e).__name__})
+        raise
+    finally:
+        finish_trace(trace)
+        current_trace.reset(token)
+
+def finish_trace(trace: Trace) -> None:
+    total = time.perf_counter() - trace.started
+    slow = total * 1000 >= TRACE_SLOW_MS
+    # Failures and slow requests are always written, successes are sampled
+    if trace.ok and not slow and random.random() >= TRACE_SAMPLE_RATE:
+        return
+    line = json.dumps(trace.to_dict(total), ensure_ascii=False)
+    trace_logger.info('%s', line)
+    if slow and TRACE_DUMP_DIR:
+        asyncio.get_running_loop().run_in_executor(None, dump_slow_trace, trace.trace_id, line, trace.pages)
+
+def dump_slow_trace(trace_id: str, line: str, pages: list) -> None:
+    try:
+        os.makedirs(TRACE_DUMP_DIR, exist_ok=True)
+        with open(os.path.join(TRACE_DUMP_DIR, f"{trace_id}.json"), 'w', encoding='utf-8') as f:
+            f.write(line + '\n')
+        for index, (url, html) in enumerate(pages):
+            with open(os.path.join(TRACE_DUMP_DIR, f"{trace_id}-{index}.html"), 'w', encoding='utf-8') as f:
+                f.write(f"<!-- {url} -->\n{html}")
+        logger.info("Slow request dumped to %s (%s page(s))", TRACE_DUMP_DIR, len(pages))
+    except OSError as e:
+        logger.warning("Could not dump slow request: %s", e)
+
+def trace_event(name: str, **attrs) -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.events.append({'name': name, 'at_ms': round((time.perf_counter() - trace.started) * 1000, 2), **attrs})
+
+def trace_failed(reason: str) -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.ok = False
+        trace_event('failed', reason=reason)
+
+def trace_page(url: str, html: str) -> None:
+    """Keep a fetched page for the slow-request dump (only when TRACE_DUMP_DIR is set)."""
+    trace = current_trace.get()
+    if trace is not None and TRACE_DUMP_DIR:
+        trace.pages.append((url, html))
+
+@contextmanager
+def timed_stage(stage: str):
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(stage, value=elapsed)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_span(stage, started, elapsed, ok)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def collect_stats() -> dict:
+    return {
+        'product_cache': product_cache.stats(),
+        'short_links': len(short_link_memo),
+        'resolved_urls': len(resolved_url_cache),
+        'photo_file_ids': len(photo_file_ids),
+        'in_flight_lookups': {'product': len(product_flight), 'shorten': len(shorten_flight)},
+        'watchlist': watchlist.count(),
+        'pending_work': len(pending_work),
+        'upstreams': {
+            limiter.name: {
+                'rate': round(limiter.rate, 3),
+                'throttles': limiter.throttles,
+                'circuit': breaker.state,
+                'failures': breaker.failures,
+            }
+            for limiter, breaker in ((amazon_limiter, amazon_breaker), (yourls_limiter, yourls_breaker))
+        },
+        'parse_pool': dict(parse_stats),
+        'scrapes': dict(scrape_stats),
+        'user_agents': ua_stats.stats(),
+        'updates': update_processor.stats() if update_processor else None,
+        'startup': startup_times,
+        'event_loop_lag': loop_lag_stats(),
+        'jobs': dict(job_stats, mode=BOT_MODE),
+    }
+
+async def health_route(method: str, path: str, headers: dict, read_body):
+    mark_startup('first_health_check')
+    return 200, 'text/plain', b'Bot is running'
+
+async def metrics_route(method: str, path: str, headers: dict, read_body):
+    return 200, 'text/plain; version=0.0.4', render_metrics().encode()
+
+async def stats_route(method: str, path: str, headers: dict, read_body):
+    return 200, 'application/json', json.dumps(collect_stats()).encode()
+
+HTTP_ROUTES = {
+    '/metrics': metrics_route,
+    '/stats': stats_route,
+}
+HTTP_REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error',
+}
+# In webhook mode this server is the public port: a client gets this long to
+# send its request line and headers (and again for the body), and no more
+HTTP_READ_TIMEOUT = 10
+HTTP_MAX_HEADERS = 100
+# Telegram updates are a few KB
+HTTP_MAX_BODY = 1024 * 1024
+
+async def read_request_head(reader: asyncio.StreamReader):
+    """Return (method, target, headers), or None for a malformed request."""
+    parts = (await reader.readline()).decode('latin-1').split()
+    if len(parts) < 2:
+        return None
+    headers = {}
+    for _ in range(HTTP_MAX_HEADERS + 1):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return parts[0], parts[1], headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return None
+
+async def handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        head = await asyncio.wait_for(read_request_head(reader), timeout=HTTP_READ_TIMEOUT)
+        if head is None:
+            return
+        method, target, headers = head
+        length = int(headers.get('content-length') or 0)
+        path = target.split('?', 1)[0]
+        route = HTTP_ROUTES.get(path, health_route)
+
+        async def read_body() -> bytes:
+            # Called by routes that take a body, once they have checked the headers
+            if not length:
+                return b''
+            return await asyncio.wait_for(reader.readexactly(length), timeout=HTTP_READ_TIMEOUT)
+
+        try:
+            if length > HTTP_MAX_BODY or length < 0:
+                status, content_type, payload = 413, 'text/plain', b'Payload too large'
+            else:
+                status, content_type, payload = await route(method, path, headers, read_body)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            raise
+        except Exception as e:
+            logger.error("HTTP handler error on %s: %s", path, e)
+            status, content_type, payload = 500, 'text/plain', b'Internal error'
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode('latin-1')
+        writer.write(head if method == 'HEAD' else head + payload)
+        await asyncio.wait_for(writer.drain(), timeout=HTTP_READ_TIMEOUT)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
         pass
+    finally:
+        writer.close()
+
+async def serve_http() -> None:
+    server = await asyncio.start_server(handle_http, '0.0.0.0', PORT)
+    logger.info("Health check server started on port %s", PORT)
+    mark_startup('health_ready')
+    async with server:
+        await server.serve_forever()
 
 def start_health_check_server():
-    server = HTTPServer(('0.0.0.0', PORT), HealthCheckHandler)
-    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    # Own event loop in its own thread: health checks and /metrics keep
+    # answering even while the bot loop is busy.
+    thread = threading.Thread(target=lambda: asyncio.run(serve_http()), name='health', daemon=True)
     thread.start()
-    logger.info(f"Health check server started on port {PORT}")
 
-def extract_amazon_url_from_text(text: str) -> str:
-    url_pattern = r'https?://[^\s\)\]]+'
-    urls = re.findall(url_pattern, text)
-    for url in urls:
+_amazon_client = None
+_yourls_client = None
+
+def _build_http_client(timeout: float, follow_redirects: bool) -> httpx.AsyncClient:
+    import httpx
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        timeout=timeout,
+        follow_redirects=follow_redirects,
+        limits=limits,
+        http2=HTTP2_ENABLED,
+    )
+
+def get_amazon_client() -> httpx.AsyncClient:
+    global _amazon_client
+    if _amazon_client is None or _amazon_client.is_closed:
+        _amazon_client = _build_http_client(timeout=15.0, follow_redirects=True)
+    return _amazon_client
+
+def get_yourls_client() -> httpx.AsyncClient:
+    global _yourls_client
+    if _yourls_client is None or _yourls_client.is_closed:
+        _yourls_client = _build_http_client(timeout=10.0, follow_redirects=False)
+    return _yourls_client
+
+async def close_http_clients(app=None) -> None:
+    global _amazon_client, _yourls_client
+    for client in (_amazon_client, _yourls_client):
+        if client is not None and not client.is_closed:
+            await client.aclose()
+    _amazon_client = None
+    _yourls_client = None
+    logger.info("HTTP clients closed")
+
+class UserAgentStats:
+    """Success rate per User-Agent and network latency of successful Amazon requests.
+
+    Latencies are kept per upstream (product pages, short link resolves) so
+    each race hedges on its own p95.
+    """
+
+    def __init__(self, user_agents: list):
+        self.user_agents = list(user_agents)
+        self.attempts = {ua: 0 for ua in user_agents}
+        self.successes = {ua: 0 for ua in user_agents}
+        self.latencies = {'amazon': deque(maxlen=200), 'amazon_short': deque(maxlen=200)}
+        self.hedges = 0
+
+    def record(self, user_agent: str, ok: bool, latency: float = None, upstream: str = 'amazon') -> None:
+        """latency: network time only, without limiter waits or parsing."""
+        self.attempts[user_agent] += 1
+        if ok:
+            self.successes[user_agent] += 1
+            if latency is not None:
+                self.latencies[upstream].append(latency)
+
+    def success_rate(self, user_agent: str) -> float:
+        # Laplace smoothing so an untried UA is neither first nor last
+        return (self.successes[user_agent] + 1) / (self.attempts[user_agent] + 2)
+
+    def ordered(self) -> list:
+        return sorted(self.user_agents, key=self.success_rate, reverse=True)
+
+    def hedge_delay(self, upstream: str = 'amazon'):
+        """Seconds to wait before launching the next UA, None for sequential fallback."""
+        if UA_STRATEGY != 'hedged':
+            return None
+        if HEDGE_DELAY != 'auto':
+            return float(HEDGE_DELAY)
+        if len(self.latencies[upstream]) < 20:
+            return 2.0
+        latencies = sorted(self.latencies[upstream])
+        return max(0.5, latencies[int(len(latencies) * 0.95) - 1])
+
+    def stats(self) -> dict:
+        return {
+            'hedges': self.hedges,
+            'hedge_delay': self.hedge_delay(),
+            'resolve_hedge_delay': self.hedge_delay('amazon_short'),
+            'user_agents': [
+                {
+                    'user_agent': ua[:60],
+                    'attempts': self.attempts[ua],
+                    'successes': self.successes[ua],
+                }
+                for ua in self.ordered()
+            ],
+        }
+
+ua_stats = UserAgentStats(USER_AGENTS)
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate halves on throttling and creeps back on success."""
+
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.throttles = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_throttle(self) -> None:
+        self._refill()
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+        self.throttles += 1
+        logger.warning("%s is throttling us, rate lowered to %.2f/s", self.name, self.rate)
+
+    def on_success(self) -> None:
+        if self.rate < self.max_rate:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class CircuitBreaker:
+    """Fails fast after repeated upstream failures, retrying once every reset_timeout."""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        # One trial request per reset_timeout; a cancelled trial just waits for the next slot
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+            self.opened_at = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != 'closed':
+            logger.info("%s circuit closed", self.name)
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning("%s circuit open for %.0fs", self.name, self.reset_timeout)
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+amazon_limiter = AdaptiveRateLimiter('amazon', AMAZON_RATE, AMAZON_BURST)
+yourls_limiter = AdaptiveRateLimiter('yourls', YOURLS_RATE, YOURLS_BURST)
+amazon_breaker = CircuitBreaker('amazon', BREAKER_FAILURES, BREAKER_RESET)
+yourls_breaker = CircuitBreaker('yourls', BREAKER_FAILURES, BREAKER_RESET)
+
+CAPTCHA_MARKERS = ('/errors/validateCaptcha', 'api-services-support@amazon.com')
+
+def is_captcha_page(html: str) -> bool:
+    return any(marker in html for marker in CAPTCHA_MARKERS)
+
+async def race_user_agents(attempt, upstream: str = 'amazon'):
+    """Run attempt(user_agent) with the best UA first, hedging with the next ones.
+
+    Another UA is started whenever the running ones fail or hedge_delay()
+    passes without a result. The first non-None result wins and the other
+    requests are cancelled. Returns None when every UA fails.
+    """
+    candidates = ua_stats.ordered()
+    delay = ua_stats.hedge_delay(upstream)
+    running = set()
+    try:
+        while candidates or running:
+            if candidates:
+                if running:
+                    ua_stats.hedges += 1
+                if len(candidates) < len(ua_stats.user_agents):
+                    UA_RETRIES.inc(upstream)
+                running.add(asyncio.create_task(attempt(candidates.pop(0))))
+            done, running = await asyncio.wait(
+                running,
+                timeout=delay if candidates else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is None and task.result() is not None:
+                    return task.result()
+        return None
+    finally:
+        for task in running:
+            task.cancel()
+
+def extract_amazon_urls_from_text(text: str) -> list:
+    amazon_urls = []
+    for url in URL_RE.findall(text):
         url = url.rstrip(')]')
-        if is_amazon_url(url):
-            logger.info(f"Extracted Amazon URL: {url}")
-            return url
-    return None
+        if is_amazon_url(url) and url not in amazon_urls:
+            amazon_urls.append(url)
+    if amazon_urls:
+        logger.debug("Extracted %s Amazon URL(s): %s", len(amazon_urls), amazon_urls[0])
+    return amazon_urls
 
-async def resolve_short_url(url: str) -> str:
+def extract_amazon_url_from_text(text: str) -> str:
+    urls = extract_amazon_urls_from_text(text)
+    return urls[0] if urls else None
+
+MAX_REDIRECTS = 10
+
+def has_product_asin(url: str) -> bool:
+    return bool(PRODUCT_PATH_RE.search(url)) and not is_short_amazon_url(url)
+
+async def _walk_redirects(client, url: str, headers: dict, prepaid: list = None, elapsed: list = None):
+    """Follow redirects by hand, stopping at the first product URL.
+
+    HEAD is tried first so no page body is downloaded; hosts that refuse
+    HEAD get a GET, and if that GET lands on the final page its HTML is
+    returned too. Returns (resolved_url, html or None), or None when a hop
+    gets an error status or the Amazon circuit is open. A token in prepaid
+    pays for the first hop; the network time of each hop is appended to elapsed.
+    """
+    current = url
+    use_head = True
+    for _ in range(MAX_REDIRECTS):
+        if not amazon_breaker.allow():
+            logger.warning("Amazon circuit open - short link left unresolved")
+            return None
+        if prepaid:
+            prepaid.pop()
+        else:
+            await amazon_limiter.acquire()
+        started = time.monotonic()
+        if use_head:
+            response = await client.head(current, headers=headers, timeout=10.0, follow_redirects=False)
+        else:
+            response = await client.get(current, headers=headers, timeout=10.0, follow_redirects=False)
+        if elapsed is not None:
+            elapsed.append(time.monotonic() - started)
+        if use_head and response.status_code in (403, 405, 501):
+            use_head = False
+            continue
+        if response.status_code >= 500 or response.status_code == 429:
+            amazon_breaker.record_failure()
+        else:
+            amazon_breaker.record_success()
+        
+        if response.is_redirect:
+            current = urljoin(current, response.headers['location'])
+            if has_product_asin(current):
+                return current, None
+            continue
+        if response.status_code != 200:
+            UPSTREAM_ERRORS.inc('amazon_short', str(response.status_code))
+            if response.status_code in (429, 503):
+                amazon_limiter.on_throttle()
+            return None
+        html = response.text if not use_head and response.status_code == 200 else None
+        return current, html
+    return current, None
+
+async def resolve_short_url_with_body(url: str):
+    """Resolve a short link to its product URL, plus the page HTML if it was fetched."""
     try:
-        for user_agent in USER_AGENTS:
-            headers = {'User-Agent': user_agent}
-            try:
-                async with httpx.AsyncClient(timeout=10.0, follow_redirects=True) as client:
-                    response = await client.get(url, headers=headers, follow_redirects=True)
-                    resolved_url = str(response.url)
-                    logger.info(f"Resolved {url} to {resolved_url}")
-                    return resolved_url
-            except:
-                continue
-        return url
+        cached = resolved_url_cache.get(url)
+    except sqlite3.Error as e:
+        logger.warning("Resolved URL cache unavailable: %s", e)
+        cached = None
+    if cached:
+        logger.debug("Resolved %s to %s (cached)", url, cached)
+        trace_event('resolved_url_cache')
+        return cached, None
+    
+    async def attempt(user_agent):
+        headers = {'User-Agent': user_agent}
+        elapsed = []
+        try:
+            result = await _walk_redirects(get_amazon_client(), url, headers, prepaid, elapsed)
+        except Exception as e:
+            ua_stats.record(user_agent, False)
+            UPSTREAM_ERRORS.inc('amazon_short', 'error')
+            logger.warning("Error resolving with user agent: %s", e)
+            return None
+        if result is None:
+            # Nothing was requested when the circuit was already open
+            if elapsed:
+                ua_stats.record(user_agent, False)
+            return None
+        ua_stats.record(user_agent, True, sum(elapsed), 'amazon_short')
+        return result
+
+    try:
+        # As in the scrape: the first hop is paid for before hedging can start
+        await amazon_limiter.acquire()
+        prepaid = [True]
+        result = await race_user_agents(attempt, 'amazon_short')
+        if result:
+            resolved_url, html = result
+            logger.debug("Resolved %s to %s", url, resolved_url)
+            if has_product_asin(resolved_url):
+                try:
+                    resolved_url_cache.set(url, resolved_url)
+                except sqlite3.Error as e:
+                    logger.warning("Could not store resolved URL: %s", e)
+            return resolved_url, html
+        return url, None
     except Exception as e:
-        logger.error(f"Error resolving short URL: {e}")
-        return url
+        logger.error("Error resolving short URL: %s", e)
+        return url, None
+
+async def resolve_short_url(url: str) -> str:
+    resolved_url, html = await resolve_short_url_with_body(url)
+    return resolved_url
 
 def extract_asin_from_url(url: str) -> str:
-    match = re.search(r'/dp/([A-Z0-9]{10})', url)
-    if match:
-        return match.group(1)
-    match = re.search(r'/gp/product/([A-Z0-9]{10})', url)
-    if match:
-        return match.group(1)
-    match = re.search(r'/d/([A-F0-9]+)', url)
-    if match:
-        return match.group(1)
+    for pattern in ASIN_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return match.group(1)
     return None
 
 def normalize_amazon_url(url: str) -> str:
@@ -117,15 +1379,15 @@ def normalize_amazon_url(url: str) -> str:
                 preserved_params[param] = query_params[param][0]
         
         if asin:
-            normalized = f"https://www.amazon.it/dp/{asin}"
+            normalized = f"{AMAZON_BASE_URL}/dp/{asin}"
             if preserved_params:
                 params_str = '&'.join([f"{k}={v}" for k, v in preserved_params.items()])
                 normalized = f"{normalized}?{params_str}"
-            logger.info(f"Normalized URL: {normalized}")
+            logger.debug("Normalized URL: %s", normalized)
             return normalized
         return url
     except Exception as e:
-        logger.error(f"Error normalizing URL: {e}")
+        logger.error("Error normalizing URL: %s", e)
         return url
 
 def extract_title(soup) -> str:
@@ -142,7 +1404,7 @@ def extract_price(soup) -> str:
         price_container = soup.find('span', {'class': 'a-price'})
         if price_container:
             price_text = price_container.get_text(strip=True)
-            prices = re.findall(r'[\d.,€\$]+', price_text)
+            prices = PRICE_TOKEN_RE.findall(price_text)
             if prices:
                 return prices[0]
         
@@ -151,7 +1413,7 @@ def extract_price(soup) -> str:
             price_text = price_elem.get_text(strip=True)
             return price_text
     except Exception as e:
-        logger.error(f"Error extracting price: {e}")
+        logger.error("Error extracting price: %s", e)
     
     return None
 
@@ -167,14 +1429,14 @@ def extract_rating(soup) -> tuple:
             rating_span = rating_elem.find('span')
             if rating_span:
                 rating_text = rating_span.get_text(strip=True)
-                match = re.search(r'[\d,]+', rating_text)
+                match = RATING_RE.search(rating_text)
                 if match:
                     rating = match.group(0)
         
         reviews_elem = soup.find('span', {'id': 'acrCustomerReviewText'})
         if reviews_elem:
             reviews_text = reviews_elem.get_text(strip=True)
-            match = re.search(r'[\d.]+', reviews_text.replace('.', ''))
+            match = REVIEWS_RE.search(reviews_text.replace('.', ''))
             if match:
                 reviews = match.group(0)
     except:
@@ -218,7 +1480,7 @@ def extract_promotion(soup) -> str:
             text = elem.get_text(strip=True)
             if any(word in text.lower() for word in ['offerta', 'sconto', 'limited time', 'deal', 'promoz']):
                 if len(text) < 100:
-                    logger.info(f"Found promotion: {text}")
+                    logger.debug("Found promotion: %s", text)
                     return text
     except:
         pass
@@ -226,23 +1488,23 @@ def extract_promotion(soup) -> str:
 
 def extract_coupon(soup) -> str:
     try:
-        coupon_elem = soup.find('div', {'class': re.compile('coupon|promotion-badge', re.I)})
+        coupon_elem = soup.find('div', {'class': COUPON_CLASS_RE})
         if coupon_elem:
             coupon_text = coupon_elem.get_text(strip=True)
             if 'coupon' in coupon_text.lower() or 'sconto' in coupon_text.lower():
-                logger.info(f"Found coupon: {coupon_text}")
+                logger.debug("Found coupon: %s", coupon_text)
                 return coupon_text
         
         for elem in soup.find_all(['span', 'div']):
             text = elem.get_text(strip=True)
             if 'coupon' in text.lower() and len(text) < 150:
-                logger.info(f"Found coupon text: {text}")
+                logger.debug("Found coupon text: %s", text)
                 return text
     except:
         pass
     return None
 
-def detect_seller_condition(url: str, soup) -> str:
+def detect_seller_condition(url: str, soup, seller_text: str = None) -> str:
     try:
         parsed = urlparse(url)
         query_params = parse_qs(parsed.query)
@@ -250,202 +1512,1387 @@ def detect_seller_condition(url: str, soup) -> str:
         aod = query_params.get('aod', [''])[0]
         s_param = query_params.get('s', [''])[0]
         
-        logger.info(f"Detected SMID: '{smid}', AOD: '{aod}', S: '{s_param}'")
+        logger.debug("Detected SMID: '%s', AOD: '%s', S: '%s'", smid, aod, s_param)
         
         if aod == '1':
-            logger.info("Found aod=1 - USED items view")
+            logger.debug("Found aod=1 - USED items view")
             return "Usato - Venduto da terzo"
         
         if 'warehouse-deals' in s_param.lower():
-            logger.info("Found warehouse-deals parameter - USED from warehouse")
+            logger.debug("Found warehouse-deals parameter - USED from warehouse")
             return "Usato - Warehouse Deals Amazon"
         
         if not smid:
-            logger.info("No SMID in URL - Sold by Amazon = NEW")
+            logger.debug("No SMID in URL - Sold by Amazon = NEW")
             return "Nuovo - Venduto da Amazon"
         
         if smid in ['A11IL2PNWYJU7H', 'AQKAJJZN6SNBQ']:
-            logger.info(f"Official Amazon SMID: {smid} - NEW")
+            logger.debug("Official Amazon SMID: %s - NEW", smid)
             return "Nuovo - Venduto da Amazon"
         
-        seller_section = soup.find('div', {'id': 'merchant-info'})
-        if seller_section:
-            seller_text = seller_section.get_text(strip=True)
-            logger.info(f"Seller section text: {seller_text[:150]}")
+        if soup is not None:
+            seller_section = soup.find('div', {'id': 'merchant-info'})
+            if seller_section:
+                seller_text = seller_section.get_text(strip=True)
+        if seller_text is not None:
+            logger.debug("Seller section text: %s", seller_text[:150])
             if 'Amazon Seconda mano' in seller_text:
-                logger.info("Found 'Amazon Seconda mano' in seller section - USED")
+                logger.debug("Found 'Amazon Seconda mano' in seller section - USED")
                 return "Usato - Venduto da Amazon Seconda mano"
         
         if smid:
-            logger.info(f"Third party SMID: {smid} - USED")
+            logger.debug("Third party SMID: %s - USED", smid)
             return "Usato - Venduto da terzo"
         
-        logger.info("Default: NEW")
+        logger.debug("Default: NEW")
         return "Nuovo - Venduto da Amazon"
         
     except Exception as e:
-        logger.error(f"Error detecting condition: {e}")
+        logger.error("Error detecting condition: %s", e)
         return "Nuovo - Venduto da Amazon"
 
-async def get_amazon_product_info(url: str) -> dict:
-    try:
-        normalized_url = normalize_amazon_url(url)
-        logger.info(f"Scraping from: {normalized_url}")
-        
-        for user_agent in USER_AGENTS:
-            try:
-                headers = {
-                    'User-Agent': user_agent,
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-                    'Accept-Language': 'it-IT,it;q=0.9,en;q=0.8',
-                }
-                
-                async with httpx.AsyncClient(timeout=15.0, follow_redirects=True) as client:
-                    response = await client.get(normalized_url, headers=headers)
-                    if response.status_code != 200:
-                        logger.warning(f"Got status {response.status_code}")
-                        continue
-                    
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    title = extract_title(soup)
-                    price = extract_price(soup)
-                    rating, reviews_count = extract_rating(soup)
-                    image_url = extract_image(soup)
-                    description = extract_description(soup)
-                    condition_status = detect_seller_condition(normalized_url, soup)
-                    promotion = extract_promotion(soup)
-                    coupon = extract_coupon(soup)
-                    
-                    logger.info(f"Scraped - Title: {title}, Price: {price}, Condition: {condition_status}")
-                    
-                    if title and title != 'Prodotto Amazon':
-                        return {
-                            'title': title,
-                            'price': price,
-                            'rating': rating,
-                            'reviews': reviews_count,
-                            'image': image_url,
-                            'description': description,
-                            'condition_status': condition_status,
-                            'promotion': promotion,
-                            'coupon': coupon,
-                        }
-            except Exception as e:
-                logger.warning(f"Error with user agent: {e}")
-                continue
-        
-        return {
-            'title': 'Prodotto Amazon',
-            'price': None,
-            'rating': None,
-            'reviews': None,
-            'image': None,
-            'description': None,
-            'condition_status': None,
-            'promotion': None,
-            'coupon': None,
-        }
-    except Exception as e:
-        logger.error(f"Error scraping: {e}")
-        return {
-            'title': 'Prodotto Amazon',
-            'price': None,
-            'rating': None,
-            'reviews': None,
-            'image': None,
-            'description': None,
-            'condition_status': None,
-            'promotion': None,
-            'coupon': None,
-        }
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    welcome = (
-        "👋 Ciao! Sono il tuo Bot per i Link Amazon con Affiliazione\n\n"
-        "📝 Cosa faccio:\n"
-        "• 📸 Scarico l'immagine\n"
-        "• ⭐ Mostro valutazioni\n"
-        "• 💬 Aggiungo descrizione\n"
-        "• 🔗 Accorcio il link\n"
-        "• 🔄 Rilevo articoli usati\n"
-        "• 🎉 Mostra promozioni e coupon\n\n"
-        "🚀 Invia un link Amazon!\n\n"
-        f"💰 Tag: `{AFFILIATE_TAG}`"
+def extract_product_fields_soup(html: str, url: str) -> ProductInfo:
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    title = extract_title(soup)
+    price = extract_price(soup)
+    rating, reviews_count = extract_rating(soup)
+    image_url = extract_image(soup)
+    description = extract_description(soup)
+    condition_status = detect_seller_condition(url, soup)
+    promotion = extract_promotion(soup)
+    coupon = extract_coupon(soup)
+    return ProductInfo(
+        title=title,
+        price=price,
+        rating=rating,
+        reviews=reviews_count,
+        image=image_url,
+        description=description,
+        condition_status=condition_status,
+        promotion=promotion,
+        coupon=coupon,
     )
-    await update.message.reply_text(welcome)
 
-async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = update.message.text
-    user = update.message.from_user
-    
-    original_url = extract_amazon_url_from_text(text)
-    
-    if not original_url:
-        logger.info(f"No Amazon URL found")
-        return
-    
-    status_msg = await update.message.reply_text("⏳ Elaborando...")
-    
-    try:
-        logger.info(f"Received URL from {user.username}: {original_url}")
-        
-        url = original_url
-        if is_short_amazon_url(url):
-            await status_msg.edit_text("🔗 Risolvendo...")
-            url = await resolve_short_url(url)
-        
-        normalized_url = normalize_amazon_url(url)
-        affiliate_url = add_affiliate_tag(normalized_url, AFFILIATE_TAG)
+VOID_TAGS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+])
+PROMOTION_WORDS = ('offerta', 'sconto', 'limited time', 'deal', 'promoz')
+class _Frame:
+    __slots__ = ('tag', 'roles', 'order', 'parts', 'size', 'limit', 'full')
+
+    def __init__(self, tag, roles, order, limit):
+        self.tag = tag
+        self.roles = roles
+        self.order = order
+        self.parts = []
+        self.size = 0
+        self.limit = limit
+        self.full = False
+
+    def text(self) -> str:
+        return ''.join(self.parts)
+
+class AmazonPageParser(HTMLParser):
+    """Single-pass extractor producing the same fields as the extract_* helpers.
+
+    Every element's text is collected while the tree is walked, capped at the
+    longest length any field needs, so no subtree is ever re-scanned.
+    """
+
+    # Text length each role needs to reproduce the BeautifulSoup helpers
+    ROLE_LIMITS = {
+        'title_id': 1000,
+        'title_class': 1000,
+        'price': 1000,
+        'price_whole': 1000,
+        'rating_small': 50,
+        'rating_big': 50,
+        'reviews': 100,
+        'bullet': 201,
+        'aplus': 151,
+        'merchant': 2000,
+        'coupon_div': 1000,
+        'candidate': 150,
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._stack = []
+        self._active = []
+        self._order = 0
+        self._skip_depth = 0
+        self._star_small_frame = None
+        self._star_big_frame = None
+        self._bullets_frame = None
+        self.found = {}
+        self.images = {}
+        self.promotion = None
+        self.promotion_order = None
+        self.coupon_text = None
+        self.coupon_order = None
+        self._text = None
+
+    def _claim(self, role: str, roles: list) -> None:
+        if role not in self.found:
+            self.found[role] = None
+            roles.append(role)
+
+    def handle_starttag(self, tag, attrs):
+        if self._text is not None:
+            self._flush_text()
+        if tag in ('script', 'style'):
+            self._skip_depth += 1
+            self._stack.append(_Frame(tag, None, -1, 0))
+            return
+        attrs = dict(attrs)
+        if tag == 'img':
+            self._handle_image(attrs)
+        if tag in VOID_TAGS:
+            return
+
+        self._order += 1
+        roles = []
+        elem_id = attrs.get('id')
+        classes = (attrs.get('class') or '').split()
+
+        if tag == 'span':
+            if elem_id == 'productTitle':
+                self._claim('title_id', roles)
+            if 'a-size-large' in classes:
+                self._claim('title_class', roles)
+            if 'a-price' in classes:
+                self._claim('price', roles)
+            if 'a-price-whole' in classes:
+                self._claim('price_whole', roles)
+            if elem_id == 'acrCustomerReviewText':
+                self._claim('reviews', roles)
+            if self._star_small_frame is not None:
+                self._claim('rating_small', roles)
+            if self._star_big_frame is not None:
+                self._claim('rating_big', roles)
+        elif tag == 'div':
+            if elem_id == 'merchant-info':
+                self._claim('merchant', roles)
+            if elem_id == 'aplus':
+                self._claim('aplus', roles)
+            if 'coupon_div' not in self.found and COUPON_CLASS_RE.search(attrs.get('class') or ''):
+                self._claim('coupon_div', roles)
+        elif tag == 'li' and self._bullets_frame is not None:
+            self._claim('bullet', roles)
+            self.found['has_bullets'] = True
+
+        if tag in ('span', 'div', 'a'):
+            roles.append('candidate')
+
+        limit = max((self.ROLE_LIMITS[role] for role in roles), default=0)
+        frame = _Frame(tag, roles, self._order, limit)
+        self._stack.append(frame)
+        if roles:
+            self._active.append(frame)
+
+        if tag == 'span':
+            if 'a-icon-star-small' in classes and 'star_small' not in self.found:
+                self.found['star_small'] = True
+                self._star_small_frame = frame
+            if 'a-icon-star' in classes and 'star_big' not in self.found:
+                self.found['star_big'] = True
+                self._star_big_frame = frame
+        elif tag == 'div' and elem_id == 'feature-bullets' and 'bullets' not in self.found:
+            self.found['bullets'] = True
+            self._bullets_frame = frame
+
+    def _handle_image(self, attrs):
+        src = attrs.get('src')
+        elem_id = attrs.get('id')
+        if elem_id in ('landingImage', 'imageBlockContainer') and elem_id not in self.images:
+            self.images[elem_id] = src
+        if 'a-dynamic-image' in (attrs.get('class') or '').split() and 'a-dynamic-image' not in self.images:
+            self.images['a-dynamic-image'] = src
+
+    def handle_endtag(self, tag):
+        if self._text is not None:
+            self._flush_text()
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i].tag == tag:
+                while len(self._stack) > i:
+                    self._close(self._stack.pop())
+                return
+
+    def _close(self, frame):
+        if frame.order < 0:
+            self._skip_depth -= 1
+            return
+        if frame is self._star_small_frame:
+            self._star_small_frame = None
+        if frame is self._star_big_frame:
+            self._star_big_frame = None
+        if frame is self._bullets_frame:
+            self._bullets_frame = None
+        if not frame.roles:
+            return
+        if not frame.full:
+            if self._active and self._active[-1] is frame:
+                self._active.pop()
+            else:
+                self._active.remove(frame)
+        text = frame.text()
+        for role in frame.roles:
+            if role == 'candidate':
+                self._check_candidate(frame, text)
+            else:
+                self.found[role] = text
+
+    def _check_candidate(self, frame, text):
+        lowered = text.lower()
+        if len(text) < 100 and (self.promotion_order is None or frame.order < self.promotion_order):
+            if any(word in lowered for word in PROMOTION_WORDS):
+                self.promotion = text
+                self.promotion_order = frame.order
+        if frame.tag != 'a' and len(text) < 150 and (self.coupon_order is None or frame.order < self.coupon_order):
+            if 'coupon' in lowered:
+                self.coupon_text = text
+                self.coupon_order = frame.order
+
+    def handle_data(self, data):
+        # A text node can arrive in pieces when the page is fed in chunks;
+        # it is handled whole at the next markup, as in a single feed()
+        if self._text is None:
+            self._text = data
+        else:
+            self._text += data
+
+    def handle_comment(self, data):
+        if self._text is not None:
+            self._flush_text()
+
+    def _flush_text(self):
+        data = self._text
+        self._text = None
+        if self._skip_depth:
+            return
+        data = data.strip()
+        if not data:
+            return
+        still_active = []
+        for frame in self._active:
+            frame.parts.append(data)
+            frame.size += len(data)
+            if frame.size >= frame.limit:
+                frame.full = True
+            else:
+                still_active.append(frame)
+        self._active = still_active
+
+    def close(self):
+        super().close()
+        if self._text is not None:
+            self._flush_text()
+        while self._stack:
+            self._close(self._stack.pop())
+
+    def required_fields_done(self) -> bool:
+        """Title, price, image and seller are final: the rest of the page cannot change them."""
+        found = self.found
+        title = found.get('title_id')
+        price = found.get('price')
+        return bool(
+            title and len(title) > 5
+            and price and PRICE_TOKEN_RE.search(price)
+            and self.images.get('landingImage')
+            and found.get('merchant') is not None
+        )
+
+    def optional_fields_done(self) -> bool:
+        found = self.found
+        # A+ content is the description only on pages without bullet points
+        return bool(
+            (found.get('rating_small') or found.get('rating_big'))
+            and found.get('reviews') is not None
+            and (found.get('bullet') or (not found.get('has_bullets') and found.get('aplus') is not None))
+            and self.promotion
+            and self.coupon() is not None
+        )
+
+    def coupon(self):
+        """The coupon result() reports: the coupon box if it talks about one, else the first coupon span."""
+        coupon_div = self.found.get('coupon_div')
+        if coupon_div and ('coupon' in coupon_div.lower() or 'sconto' in coupon_div.lower()):
+            return coupon_div
+        return self.coupon_text
+
+    def result(self, url: str) -> ProductInfo:
+        found = self.found
+
+        title = DEFAULT_PRODUCT_TITLE
+        for role in ('title_id', 'title_class'):
+            text = found.get(role)
+            if text and len(text) > 5:
+                title = text
+                break
+
+        price = None
+        if found.get('price') is not None:
+            prices = PRICE_TOKEN_RE.findall(found['price'])
+            if prices:
+                price = prices[0]
+        if price is None and found.get('price_whole') is not None:
+            price = found['price_whole']
+
+        rating = None
+        star_role = 'rating_small' if found.get('star_small') else 'rating_big'
+        if found.get(star_role):
+            match = RATING_RE.search(found[star_role])
+            if match:
+                rating = match.group(0)
+        reviews = None
+        if found.get('reviews') is not None:
+            match = REVIEWS_RE.search(found['reviews'].replace('.', ''))
+            if match:
+                reviews = match.group(0)
+
+        image = None
+        for key in ('landingImage', 'imageBlockContainer', 'a-dynamic-image'):
+            if self.images.get(key):
+                image = self.images[key]
+                break
+
+        description = None
+        if found.get('has_bullets'):
+            description = found.get('bullet') or ''
+            if len(description) > 200:
+                description = description[:200] + "..."
+        elif found.get('aplus') is not None:
+            description = found['aplus']
+            if len(description) > 150:
+                description = description[:150] + "..."
+
+        coupon = self.coupon()
+        if coupon:
+            logger.debug("Found coupon: %s", coupon)
+        if self.promotion:
+            logger.debug("Found promotion: %s", self.promotion)
+
+        return ProductInfo(
+            title=title,
+            price=price,
+            rating=rating,
+            reviews=reviews,
+            image=image,
+            description=description,
+            condition_status=detect_seller_condition(url, None, seller_text=found.get('merchant')),
+            promotion=self.promotion,
+            coupon=coupon,
+        )
+
+def extract_product_fields_stream(html: str, url: str) -> ProductInfo:
+    parser = AmazonPageParser()
+    parser.feed(html)
+    parser.close()
+    return parser.result(url)
+
+STREAM_FEED_CHARS = 32 * 1024
+CAPTCHA_MARKER_LEN = max(len(marker) for marker in CAPTCHA_MARKERS)
+
+async def read_product_stream(response, url: str):
+    """Parse a product page while it downloads; returns (product_info, is_captcha).
+
+    Reading stops once the required fields are final and either the optional
+    ones are too or STREAM_OPTIONAL_BUDGET more characters went by without
+    them. Leaving the stream early closes the connection, so the rest of the
+    page is never transferred. Unless PARSE_POOL=none the parser is fed in a
+    worker thread, about 32 KB at a time, so the event loop stays free.
+    """
+    parser = AmazonPageParser()
+    loop = asyncio.get_running_loop()
+
+    async def run_parser(fn, *args):
+        if PARSE_POOL == 'none':
+            return fn(*args)
+        return await loop.run_in_executor(None, fn, *args)
+
+    kept = [] if TRACE_DUMP_DIR and current_trace.get() is not None else None
+    tail = ''
+    pending = []
+    pending_size = 0
+    read = 0
+    required_at = None
+    parse_time = 0.0
+    early = False
+    async for chunk in response.aiter_text():
+        # The tail of the previous chunk catches a marker split across two chunks
+        if is_captcha_page(tail + chunk):
+            return None, True
+        tail = chunk[-CAPTCHA_MARKER_LEN:]
+        if kept is not None:
+            kept.append(chunk)
+        read += len(chunk)
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size < STREAM_FEED_CHARS:
+            continue
+        started = time.perf_counter()
+        await run_parser(parser.feed, ''.join(pending))
+        parse_time += time.perf_counter() - started
+        pending = []
+        pending_size = 0
+        if required_at is None and parser.required_fields_done():
+            required_at = read
+        if required_at is not None and (parser.optional_fields_done() or read - required_at >= STREAM_OPTIONAL_BUDGET):
+            early = True
+            break
+
+    def finish():
+        if pending:
+            parser.feed(''.join(pending))
+        parser.close()
+        return parser.result(url)
+
+    started = time.perf_counter()
+    product_info = await run_parser(finish)
+    STAGE_SECONDS.observe('parse', value=parse_time + time.perf_counter() - started)
+    trace_event('stream', chars=read, early=early)
+    if kept is not None:
+        trace_page(url, ''.join(kept))
+    return product_info, False
+
+PRODUCT_EXTRACTORS = {
+    'soup': extract_product_fields_soup,
+    'stream': extract_product_fields_stream,
+}
+
+def extract_product_fields(html: str, url: str) -> ProductInfo:
+    extractor = PRODUCT_EXTRACTORS.get(HTML_EXTRACTOR, extract_product_fields_stream)
+    return extractor(html, url)
+
+def _extract_packed_fields(html: str, url: str) -> tuple:
+    # Workers send back the bare tuple, the cheapest thing to pickle
+    return extract_product_fields(html, url).pack()
+
+_parse_executor = None
+_parse_slots = None
+parse_stats = {'in_flight': 0, 'waiting': 0, 'parsed': 0}
+
+def get_parse_executor():
+    global _parse_executor
+    if _parse_executor is None and PARSE_POOL in ('process', 'thread'):
+        if PARSE_POOL == 'process':
+            # spawn: forking a process that already runs the event loop and
+            # the health check thread can deadlock on inherited locks
+            _parse_executor = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        else:
+            _parse_executor = ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix='parse')
+        logger.info("Parse pool started: %s x%s", PARSE_POOL, PARSE_WORKERS)
+    return _parse_executor
+
+def shutdown_parse_pool() -> None:
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+        _parse_executor = None
+        logger.info("Parse pool stopped")
+
+async def parse_product_page(html: str, url: str) -> ProductInfo:
+    global _parse_slots
+    executor = get_parse_executor()
+    if executor is None:
+        return extract_product_fields(html, url)
+    if _parse_slots is None:
+        _parse_slots = asyncio.Semaphore(PARSE_WORKERS + PARSE_QUEUE_SIZE)
+    if _parse_slots.locked():
+        logger.warning("Parse queue full, waiting for a free worker")
+    parse_stats['waiting'] += 1
+    async with _parse_slots:
+        parse_stats['waiting'] -= 1
+        parse_stats['in_flight'] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            packed = await loop.run_in_executor(executor, _extract_packed_fields, html, url)
+            return ProductInfo.unpack(packed)
+        except BrokenProcessPool:
+            logger.error("Parse pool broken, restarting it and parsing inline")
+            shutdown_parse_pool()
+            return extract_product_fields(html, url)
+        finally:
+            parse_stats['in_flight'] -= 1
+            parse_stats['parsed'] += 1
+
+_background_tasks = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+_scrape_slots = None
+scrape_stats = {'in_flight': 0, 'waiting': 0}
+
+async def scrape_product(normalized_url: str) -> ProductInfo:
+    global _scrape_slots
+    if _scrape_slots is None:
+        _scrape_slots = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+    scrape_stats['waiting'] += 1
+    async with _scrape_slots:
+        scrape_stats['waiting'] -= 1
+        scrape_stats['in_flight'] += 1
+        try:
+            return await _scrape_amazon_product_info(normalized_url)
+        finally:
+            scrape_stats['in_flight'] -= 1
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one in-flight call."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._calls = {}
+
+    async def run(self, key: str, factory):
+        future = self._calls.get(key)
+        if future is not None:
+            COALESCED_REQUESTS.inc(self.kind)
+            logger.debug("Joining in-flight %s request: %s", self.kind, key)
+        else:
+            future = asyncio.ensure_future(factory())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        # shield: a cancelled caller must not cancel the call others are awaiting
+        return await asyncio.shield(future)
+
+    def _forget(self, key: str, future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception()
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+product_flight = SingleFlight('product')
+shorten_flight = SingleFlight('shorten')
+
+_refreshing_products = set()
+
+async def _refresh_product(normalized_url: str) -> None:
+    try:
+        product_info = await scrape_product(normalized_url)
+        if product_info.found:
+            product_cache.put(normalized_url, product_info)
+            product_cache.refreshes += 1
+            logger.info("Refreshed cached product: %s", normalized_url)
+    finally:
+        _refreshing_products.discard(normalized_url)
+
+async def get_amazon_product_info(url: str, page_html: str = None) -> ProductInfo:
+    with timed_stage('product'):
+        normalized_url = normalize_amazon_url(url)
+        cached = product_cache.get(normalized_url)
+        if cached:
+            product_info, is_stale = cached
+            if is_stale and normalized_url not in _refreshing_products:
+                _refreshing_products.add(normalized_url)
+                run_in_background(_refresh_product(normalized_url))
+            logger.debug("Product cache %s: %s", 'stale hit' if is_stale else 'hit', normalized_url)
+            trace_event('product_cache', result='stale' if is_stale else 'hit')
+            return product_info
+        
+        trace_event('product_cache', result='miss')
+        product_info = await product_flight.run(normalized_url, lambda: _load_product(normalized_url, page_html))
+        if not product_info.found:
+            trace_failed('scrape_failed')
+        return product_info
+
+async def _load_product(normalized_url: str, page_html: str = None) -> ProductInfo:
+    if page_html:
+        # The page was already downloaded while resolving a short link
+        with timed_stage('parse'):
+            product_info = await parse_product_page(page_html, normalized_url)
+        if product_info.found:
+            product_cache.put(normalized_url, product_info)
+            return product_info
+    
+    product_info = await scrape_product(normalized_url)
+    if product_info.found:
+        product_cache.put(normalized_url, product_info)
+        return product_info
+    
+    fallback = product_cache.get_fallback(normalized_url)
+    if fallback:
+        logger.info("Scrape failed, using cached product without price: %s", normalized_url)
+        return fallback
+    return product_info
+
+async def _scrape_amazon_product_info(url: str) -> ProductInfo:
+    import httpx
+    try:
+        normalized_url = normalize_amazon_url(url)
+        logger.debug("Scraping from: %s", normalized_url)
+        
+        async def attempt(user_agent):
+            headers = {
+                'User-Agent': user_agent,
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+                'Accept-Language': 'it-IT,it;q=0.9,en;q=0.8',
+                'Accept-Encoding': ACCEPT_ENCODING,
+            }
+            if not amazon_breaker.allow():
+                return None
+            try:
+                if prepaid:
+                    prepaid.pop()
+                else:
+                    await amazon_limiter.acquire()
+                client = get_amazon_client()
+                product_info = None
+                captcha = False
+                # Latency for the hedge delay: from the request to the response
+                # headers, so neither the body nor its parsing is counted
+                started = time.monotonic()
+                if STREAM_FETCH and HTML_EXTRACTOR == 'stream':
+                    # Parsed while downloading; 'fetch' includes the parse time here
+                    with timed_stage('fetch'):
+                        async with client.stream('GET', normalized_url, headers=headers) as response:
+                            latency = time.monotonic() - started
+                            if response.status_code == 200:
+                                product_info, captcha = await read_product_stream(response, normalized_url)
+                else:
+                    with timed_stage('fetch'):
+                        async with client.stream('GET', normalized_url, headers=headers) as response:
+                            latency = time.monotonic() - started
+                            await response.aread()
+                    if response.status_code == 200:
+                        trace_page(normalized_url, response.text)
+                        captcha = is_captcha_page(response.text)
+                        if not captcha:
+                            with timed_stage('parse'):
+                                product_info = await parse_product_page(response.text, normalized_url)
+                if response.status_code != 200:
+                    logger.warning("Got status %s", response.status_code)
+                    UPSTREAM_ERRORS.inc('amazon', str(response.status_code))
+                    ua_stats.record(user_agent, False)
+                    if response.status_code in (429, 503):
+                        amazon_limiter.on_throttle()
+                    if response.status_code >= 500 or response.status_code == 429:
+                        amazon_breaker.record_failure()
+                    else:
+                        amazon_breaker.record_success()
+                        misses.append(response.status_code)
+                    return None
+                if captcha:
+                    logger.warning("Got captcha page")
+                    UPSTREAM_ERRORS.inc('amazon', 'captcha')
+                    ua_stats.record(user_agent, False)
+                    amazon_limiter.on_throttle()
+                    amazon_breaker.record_failure()
+                    return None
+                
+                logger.debug("Scraped - Title: %s, Price: %s, Condition: %s", product_info.title, product_info.price, product_info.condition_status)
+            except Exception as e:
+                logger.warning("Error with user agent: %s", e)
+                UPSTREAM_ERRORS.inc('amazon', 'error')
+                ua_stats.record(user_agent, False)
+                if isinstance(e, httpx.TransportError):
+                    amazon_breaker.record_failure()
+                return None
+            
+            amazon_breaker.record_success()
+            amazon_limiter.on_success()
+            ok = product_info.found
+            ua_stats.record(user_agent, ok, latency)
+            if not ok:
+                misses.append(response.status_code)
+            return product_info if ok else None
+        
+        # The first request's token is taken before the race: a wait on the
+        # limiter must not look like a slow Amazon and start hedged requests
+        await amazon_limiter.acquire()
+        prepaid = [True]
+        misses = []
+        product_info = await race_user_agents(attempt)
+        if product_info:
+            return product_info
+        
+        return ProductInfo(unavailable=not misses)
+    except Exception as e:
+        logger.error("Error scraping: %s", e)
+        return ProductInfo()
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    welcome = (
+        "👋 Ciao! Sono il tuo Bot per i Link Amazon con Affiliazione\n\n"
+        "📝 Cosa faccio:\n"
+        "• 📸 Scarico l'immagine\n"
+        "• ⭐ Mostro valutazioni\n"
+        "• 💬 Aggiungo descrizione\n"
+        "• 🔗 Accorcio il link\n"
+        "• 🔄 Rilevo articoli usati\n"
+        "• 🎉 Mostra promozioni e coupon\n"
+        "• 👀 Avviso sui cambi di prezzo con /watch\n\n"
+        "🚀 Invia un link Amazon!\n\n"
+        f"💰 Tag: `{AFFILIATE_TAG}`"
+    )
+    await update.message.reply_text(welcome)
+
+async def watch_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.message.chat_id
+    urls = extract_amazon_urls_from_text(' '.join(context.args or []))
+    if not urls:
+        await update.message.reply_text(
+            "👀 Uso: /watch <link Amazon>\n"
+            "Ti avviso quando cambiano prezzo, coupon o offerte.\n\n"
+            f"Prodotti monitorati in questa chat: {watchlist.count(chat_id)}"
+        )
+        return
+    
+    # Only the links are resolved here: product pages are read by the price
+    # watcher, within WATCH_BUDGET_PER_MINUTE, starting with these
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def resolve(url):
+        async with slots:
+            try:
+                if is_short_amazon_url(url):
+                    url = await resolve_short_url(url)
+                return normalize_amazon_url(url)
+            except Exception as e:
+                logger.error("Watch error for %s: %s", url, e)
+                return None
+    
+    names = []
+    for normalized_url in await asyncio.gather(*[resolve(url) for url in urls[:BATCH_MAX_LINKS]]):
+        asin = extract_asin_from_url(normalized_url) if normalized_url else None
+        if not asin:
+            continue
+        watchlist.add(chat_id, asin, normalized_url, time.time())
+        cached = product_cache.get(normalized_url)
+        name = cached[0].title if cached else asin
+        if name not in names:
+            names.append(name)
+    
+    if not names:
+        await update.message.reply_text("❌ Nessun prodotto Amazon valido.")
+        return
+    logger.info("Chat %s watching %s product(s)", chat_id, len(names))
+    await update.message.reply_text("👀 Monitoraggio attivo per:\n" + '\n'.join(f"• {name}" for name in names))
+
+async def unwatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.message.chat_id
+    removed = 0
+    for arg in context.args or []:
+        url = arg
+        if is_short_amazon_url(url):
+            url = await resolve_short_url(url)
+        asin = extract_asin_from_url(url) or arg.upper()
+        removed += watchlist.remove(chat_id, asin)
+    if removed:
+        await update.message.reply_text(f"🗑️ Monitoraggio rimosso per {removed} prodotti.")
+    else:
+        await update.message.reply_text("❌ Uso: /unwatch <link Amazon o ASIN>")
+
+def inline_query_url(query: str):
+    """Product URL for an inline query holding a link or a bare ASIN, without any network call."""
+    urls = extract_amazon_urls_from_text(query)
+    if urls:
+        url = urls[0]
+        if is_short_amazon_url(url):
+            try:
+                return resolved_url_cache.get(url), url
+            except sqlite3.Error:
+                return None, url
+        return url, None
+    match = ASIN_QUERY_RE.match(query.upper())
+    if match:
+        return f"{AMAZON_BASE_URL}/dp/{match.group(1)}", None
+    return None, None
+
+async def warm_inline_result(url: str) -> None:
+    try:
+        if is_short_amazon_url(url):
+            url = await resolve_short_url(url)
+        normalized_url = normalize_amazon_url(url)
+        await asyncio.gather(
+            get_amazon_product_info(normalized_url),
+            shorten_with_yourls(add_affiliate_tag(normalized_url, AFFILIATE_TAG)),
+        )
+    except Exception as e:
+        logger.warning("Inline warm-up failed for %s: %s", url, e)
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Inline answers only read caches: anything missing is fetched in the
+    # background, so the next keystroke finds it ready.
+    from telegram import InlineQueryResultArticle, InlineQueryResultCachedPhoto, InlineQueryResultPhoto, InputTextMessageContent
+    query = update.inline_query.query.strip()
+    url, short_link = inline_query_url(query)
+    normalized_url = normalize_amazon_url(url) if url else None
+    asin = extract_asin_from_url(normalized_url) if normalized_url else None
+    if asin is None:
+        if short_link:
+            run_in_background(warm_inline_result(short_link))
+        INLINE_ANSWERS.inc('none')
+        await update.inline_query.answer([], cache_time=0)
+        return
+    
+    affiliate_url = add_affiliate_tag(normalized_url, AFFILIATE_TAG)
+    short_url = memoized_short_link(affiliate_url)
+    cached = product_cache.get(normalized_url)
+    if cached is None or short_url is None:
+        run_in_background(warm_inline_result(normalized_url))
+    
+    if cached is None:
+        INLINE_ANSWERS.inc('minimal')
+        link = short_url or affiliate_url
+        result = InlineQueryResultArticle(
+            id=f"{asin}-link",
+            title="🔗 Link affiliato Amazon",
+            description=link,
+            input_message_content=InputTextMessageContent(f"🛒 {link}"),
+        )
+        await update.inline_query.answer([result], cache_time=0)
+        return
+    
+    INLINE_ANSWERS.inc('full')
+    product_info = cached[0]
+    short_url = short_url or affiliate_url
+    message = build_product_message(product_info, short_url)
+    description = ' | '.join(part for part in (product_info.price, product_info.condition_status) if part)
+    if product_info.image:
+        file_id = cached_photo(product_info.image)
+        if file_id:
+            result = InlineQueryResultCachedPhoto(
+                id=asin, photo_file_id=file_id, title=product_info.title,
+                description=description, caption=message, parse_mode='HTML',
+            )
+        else:
+            result = InlineQueryResultPhoto(
+                id=asin, photo_url=product_info.image, thumbnail_url=product_info.image,
+                title=product_info.title, description=description, caption=message, parse_mode='HTML',
+            )
+    else:
+        result = InlineQueryResultArticle(
+            id=asin, title=product_info.title, description=description,
+            input_message_content=InputTextMessageContent(message, parse_mode='HTML'),
+        )
+    # A card built with the long link is not worth caching on Telegram's side
+    cache_time = INLINE_CACHE_TIME if short_url != affiliate_url and not cached[1] else 0
+    await update.inline_query.answer([result], cache_time=cache_time)
+
+class StatusMessage:
+    """Progress reply whose send, edits and delete run in the background, in order.
+
+    An edit that has not started yet when a newer one is queued is skipped, so a
+    fast request costs only the reply and the final delete.
+    """
+
+    def __init__(self, message, text: str):
+        self._sent = run_in_background(message.reply_text(text))
+        self._last = self._sent
+        self._seq = 0
+
+    def _chain(self, action: str, text: str = None) -> None:
+        previous = self._last
+        self._seq += 1
+        seq = self._seq
+
+        async def run():
+            try:
+                await previous
+            except Exception:
+                pass
+            if action == 'edit' and seq != self._seq:
+                return
+            try:
+                status = await self._sent
+                if action == 'edit':
+                    await status.edit_text(text)
+                else:
+                    await status.delete()
+            except Exception as e:
+                logger.warning("Status message %s failed: %s", action, e)
+
+        self._last = run_in_background(run())
+
+    def edit(self, text: str) -> None:
+        self._chain('edit', text)
+
+    def delete(self) -> None:
+        self._chain('delete')
+
+    @property
+    def message_id(self):
+        if self._sent.done() and not self._sent.cancelled() and self._sent.exception() is None:
+            return self._sent.result().message_id
+        return None
+
+PENDING_WORK_MAX_AGE = 3600
+
+class PendingWork:
+    """Link messages whose handling has started but not finished.
+
+    A handler cancelled by shutdown leaves its entry here, so the snapshot
+    taken afterwards carries it over to the next process.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+
+    def add(self, job: dict) -> str:
+        key = f"{job['chat_id']}:{job['message_id']}"
+        self._jobs[key] = (job, None)
+        return key
+
+    def add_message(self, message, urls: list) -> str:
+        return self.add({
+            'chat_id': message.chat_id,
+            'message_id': message.message_id,
+            'urls': urls,
+            'first_name': message.from_user.first_name if message.from_user else None,
+            'received_at': time.time(),
+        })
+
+    def add_update(self, update) -> None:
+        """Register a queued link message before its handler gets to run."""
+        message = getattr(update, 'message', None)
+        if message is None or not message.text or message.text.startswith('/'):
+            return
+        urls = extract_amazon_urls_from_text(message.text)
+        if urls:
+            self.add_message(message, urls)
+
+    def track_status(self, key: str, status_msg: StatusMessage) -> None:
+        if key in self._jobs:
+            self._jobs[key] = (self._jobs[key][0], status_msg)
+
+    def done(self, key: str) -> None:
+        self._jobs.pop(key, None)
+
+    def export(self) -> list:
+        jobs = []
+        for job, status_msg in list(self._jobs.values()):
+            job = dict(job)
+            job['status_message_id'] = status_msg.message_id if status_msg else job.get('status_message_id')
+            jobs.append(job)
+        return jobs
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+pending_work = PendingWork()
+
+async def delete_quietly(message) -> None:
+    try:
+        await message.delete()
+    except Exception:
+        pass
+
+async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    text = update.message.text
+    
+    urls = extract_amazon_urls_from_text(text)
+    
+    if not urls:
+        logger.debug("No Amazon URL found")
+        return
+    
+    if BOT_MODE == 'frontend':
+        # From here the job queue keeps the message across restarts, not pending_work
+        try:
+            await enqueue_link_job(update.message, urls)
+        except Exception as e:
+            logger.error("Enqueue error: %s", e)
+            await update.message.reply_text("❌ Errore.\nRiprova.")
+        finally:
+            pending_work.done(f"{update.message.chat_id}:{update.message.message_id}")
+        return
+    
+    job = pending_work.add_message(update.message, urls)
+    cancelled = False
+    handle_url_stats['in_flight'] += 1
+    with start_trace('handle_url', chat_id=update.message.chat_id, links=len(urls)):
+        try:
+            if len(urls) > 1:
+                await handle_batch(update, urls, job)
+            else:
+                await handle_single_url(update, context, urls[0], job)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            handle_url_stats['in_flight'] -= 1
+            if not cancelled:
+                pending_work.done(job)
+
+async def enqueue_link_job(message, urls: list) -> None:
+    """Acknowledge a link message and leave scraping and posting to a worker."""
+    status = await message.reply_text("⏳ In coda...")
+    job = {
+        'chat_id': message.chat_id,
+        'message_id': message.message_id,
+        'urls': urls,
+        'first_name': message.from_user.first_name if message.from_user else None,
+        'received_at': time.time(),
+        'status_message_id': status.message_id,
+    }
+    await queue_job(message.get_bot(), job)
+
+async def queue_job(bot, job: dict) -> None:
+    key = f"{job['chat_id']}:{job['message_id']}"
+    if await get_job_queue().enqueue(key, job):
+        job_stats['enqueued'] += 1
+        logger.info("Queued message %s (%s link(s))", key, len(job['urls']))
+        return
+    job_stats['duplicates'] += 1
+    logger.info("Message %s already queued", key)
+    if job.get('status_message_id'):
+        try:
+            await bot.delete_message(job['chat_id'], job['status_message_id'])
+        except Exception:
+            pass
+
+async def handle_single_url(update: Update, context: ContextTypes.DEFAULT_TYPE, original_url: str, job: str = None) -> None:
+    user = update.message.from_user
+    started = time.perf_counter()
+    status_msg = StatusMessage(update.message, "⏳ Elaborando...")
+    pending_work.track_status(job, status_msg)
+    
+    try:
+        logger.info("Received URL from %s: %s", user.username, original_url)
         
-        await status_msg.edit_text("📸 Scaricando...")
-        product_info = await get_amazon_product_info(normalized_url)
+        url = original_url
+        page_html = None
+        if is_short_amazon_url(url):
+            status_msg.edit("🔗 Risolvendo...")
+            with timed_stage('resolve'):
+                url, page_html = await resolve_short_url_with_body(url)
+            if page_html:
+                trace_page(url, page_html)
         
-        await status_msg.edit_text("🔗 Accorciando...")
-        short_url = await shorten_with_yourls(affiliate_url)
+        normalized_url = normalize_amazon_url(url)
+        affiliate_url = add_affiliate_tag(normalized_url, AFFILIATE_TAG)
+        
+        status_msg.edit("📸 Scaricando...")
+        product_info, short_url = await asyncio.gather(
+            get_amazon_product_info(normalized_url, page_html),
+            shorten_with_yourls(affiliate_url),
+        )
         
         if not short_url:
-            await status_msg.edit_text("❌ Errore accorciamento.\nRiprova.")
+            status_msg.edit("❌ Errore accorciamento.\nRiprova.")
             return
         
-        logger.info(f"Shortened to: {short_url}")
+        logger.debug("Shortened to: %s", short_url)
         
         message = build_product_message(product_info, short_url, user.first_name)
-        await status_msg.delete()
+        status_msg.delete()
+        run_in_background(delete_quietly(update.message))
         
+        with timed_stage('send'):
+            await send_product_post(context.bot, update.message.chat_id, product_info, message, short_url)
+        
+    except Exception as e:
+        logger.error("Error: %s", e)
+        trace_failed(type(e).__name__)
+        status_msg.edit("❌ Errore.\nRiprova.")
+    finally:
+        STAGE_SECONDS.observe('total', value=time.perf_counter() - started)
+
+# Telegram errors meaning it could not fetch the photo itself, as opposed to caption errors
+PHOTO_FETCH_ERRORS = ('http url', 'web page content', 'file identifier', 'image_process_failed')
+PHOTO_MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+def cached_photo(image_url: str):
+    try:
+        return photo_file_ids.get(image_url)
+    except sqlite3.Error as e:
+        logger.warning("Photo file_id cache unavailable: %s", e)
+        return None
+
+def remember_photo(image_url: str, message) -> None:
+    if message is None or not getattr(message, 'photo', None):
+        return
+    try:
+        photo_file_ids.set(image_url, message.photo[-1].file_id)
+    except sqlite3.Error as e:
+        logger.warning("Could not store photo file_id: %s", e)
+
+async def download_image(image_url: str) -> bytes:
+    client = get_amazon_client()
+    with timed_stage('image_download'):
+        response = await client.get(image_url)
+    response.raise_for_status()
+    if len(response.content) > PHOTO_MAX_UPLOAD_BYTES:
+        raise ValueError(f"image too large ({len(response.content)} bytes)")
+    return response.content
+
+async def send_product_photo(bot, chat_id: int, image_url: str, caption: str) -> None:
+    """Send by cached file_id, then by URL, and upload the bytes ourselves only if Telegram can't fetch them."""
+    from telegram.error import BadRequest
+    file_id = cached_photo(image_url)
+    if file_id:
+        try:
+            await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, parse_mode='HTML')
+            PHOTO_SOURCES.inc('file_id')
+            return
+        except BadRequest as e:
+            if not any(marker in str(e).lower() for marker in PHOTO_FETCH_ERRORS):
+                raise
+            logger.warning("Cached file_id rejected, sending by URL: %s", e)
+            photo_file_ids.delete(image_url)
+    
+    try:
+        sent = await bot.send_photo(chat_id=chat_id, photo=image_url, caption=caption, parse_mode='HTML')
+        source = 'url'
+    except BadRequest as e:
+        if not any(marker in str(e).lower() for marker in PHOTO_FETCH_ERRORS):
+            raise
+        logger.warning("Telegram could not fetch the image, uploading it: %s", e)
+        data = await download_image(image_url)
+        sent = await bot.send_photo(chat_id=chat_id, photo=data, caption=caption, parse_mode='HTML')
+        source = 'upload'
+    PHOTO_SOURCES.inc(source)
+    remember_photo(image_url, sent)
+
+async def send_product_post(bot, chat_id: int, product_info: ProductInfo, message: str, short_url: str) -> None:
+    if product_info.image:
+        try:
+            await send_product_photo(bot, chat_id, product_info.image, message)
+            logger.debug("Sent photo")
+        except Exception as e:
+            logger.warning("Photo error: %s", e)
+            PHOTO_SEND_FAILURES.inc()
+            fallback = f"<b>{product_info.title or 'Prodotto'}</b>\n\n{short_url}"
+            try:
+                await bot.send_message(chat_id, fallback, parse_mode='HTML')
+            except:
+                await bot.send_message(chat_id, f"Link: {short_url}")
+    else:
+        logger.debug("No image")
         try:
-            await update.message.delete()
+            await bot.send_message(chat_id, message, parse_mode='HTML')
         except:
-            pass
-        
-        if product_info.get('image'):
+            fallback = f"<b>{product_info.title or 'Prodotto'}</b>\n\n{short_url}"
+            await bot.send_message(chat_id, fallback, parse_mode='HTML')
+
+def jittered(interval: float) -> float:
+    return interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+async def read_watched_product(url: str) -> ProductInfo:
+    """Current price fields of a product: a fresh cache entry or a new scrape, never the priceless fallback."""
+    cached = product_cache.get(url)
+    if cached and not cached[1]:
+        # Someone else looked this product up recently: no request needed
+        return cached[0]
+    product_info = await scrape_product(url)
+    if product_info.found:
+        product_cache.put(url, product_info)
+    return product_info
+
+async def check_watched_product(bot, item: dict) -> None:
+    from telegram.error import Forbidden
+    chat_id, asin, url = item['chat_id'], item['asin'], item['url']
+    product_info = await read_watched_product(url)
+    
+    if not product_info.found and item['awaiting_baseline'] and not product_info.unavailable:
+        # Amazon answered, but not with a product: nothing to watch
+        WATCH_CHECKS.inc('not_found')
+        watchlist.remove(chat_id, asin)
+        try:
+            await bot.send_message(chat_id, f"❌ Prodotto {asin} non trovato: monitoraggio annullato.")
+        except Exception as e:
+            logger.info("Could not tell chat %s about %s: %s", chat_id, asin, e)
+        return
+    
+    if not product_info.found:
+        WATCH_CHECKS.inc('error')
+        interval = min(item['interval'] * 2, WATCH_MAX_INTERVAL)
+        watchlist.reschedule(chat_id, asin, interval, time.time() + jittered(interval))
+        return
+    
+    if item['awaiting_baseline']:
+        # First reading since /watch: it is what later checks compare against
+        WATCH_CHECKS.inc('baseline')
+        watchlist.reschedule(chat_id, asin, WATCH_MIN_INTERVAL, time.time() + jittered(WATCH_MIN_INTERVAL), product_info)
+        return
+    
+    if all(getattr(product_info, field) == item[field] for field in FAST_PRODUCT_FIELDS):
+        WATCH_CHECKS.inc('unchanged')
+        interval = min(item['interval'] * 2, WATCH_MAX_INTERVAL)
+        watchlist.reschedule(chat_id, asin, interval, time.time() + jittered(interval))
+        return
+    
+    WATCH_CHECKS.inc('changed')
+    logger.info("Watched product changed: %s for chat %s (%s -> %s)", asin, chat_id, item['price'], product_info.price)
+    watchlist.reschedule(chat_id, asin, WATCH_MIN_INTERVAL, time.time() + jittered(WATCH_MIN_INTERVAL), product_info)
+    short_url = await shorten_with_yourls(add_affiliate_tag(url, AFFILIATE_TAG))
+    message = f"<b>🔔 Prodotto monitorato aggiornato</b>\n💵 Prima: {item['price'] or 'N/D'}\n"
+    message += build_product_message(product_info, short_url)
+    try:
+        await send_product_post(bot, chat_id, product_info, message, short_url)
+    except Forbidden:
+        logger.info("Chat %s blocked the bot, dropping watched product %s", chat_id, asin)
+        watchlist.remove(chat_id, asin)
+
+async def price_watch_loop(bot) -> None:
+    # At most one check per slot: a long watchlist only makes each item come
+    # round less often, it never raises the request rate.
+    slot = 60 / WATCH_BUDGET_PER_MINUTE
+    while True:
+        started = time.monotonic()
+        try:
+            item = watchlist.next_due(time.time())
+            if item is not None:
+                with start_trace('watch', chat_id=item['chat_id'], asin=item['asin']):
+                    await check_watched_product(bot, item)
+        except Exception as e:
+            logger.error("Price watch error: %s", e)
+        await asyncio.sleep(max(0.0, slot - (time.monotonic() - started)))
+
+_price_watch_task = None
+
+def start_price_watcher(app: Application) -> None:
+    global _price_watch_task
+    if WATCH_BUDGET_PER_MINUTE > 0 and _price_watch_task is None:
+        _price_watch_task = run_in_background(price_watch_loop(app.bot))
+        logger.info("Price watcher started (%g checks/min)", WATCH_BUDGET_PER_MINUTE)
+
+def stop_price_watcher() -> None:
+    global _price_watch_task
+    if _price_watch_task is not None:
+        _price_watch_task.cancel()
+        _price_watch_task = None
+
+async def process_batch_link(url: str):
+    page_html = None
+    if is_short_amazon_url(url):
+        with timed_stage('resolve'):
+            url, page_html = await resolve_short_url_with_body(url)
+    normalized_url = normalize_amazon_url(url)
+    affiliate_url = add_affiliate_tag(normalized_url, AFFILIATE_TAG)
+    product_info, short_url = await asyncio.gather(
+        get_amazon_product_info(normalized_url, page_html),
+        shorten_with_yourls(affiliate_url),
+    )
+    return extract_asin_from_url(normalized_url) or normalized_url, product_info, short_url
+
+def build_batch_entry(index: int, product_info: ProductInfo, short_url: str) -> str:
+    title = product_info.title or DEFAULT_PRODUCT_TITLE
+    if len(title) > 70:
+        title = title[:67].rstrip() + '...'
+    entry = f"<b>{index}. {title}</b>\n"
+    details = []
+    if product_info.price:
+        details.append(f"💵 {PRICE_SUFFIX_RE.sub('€', product_info.price).strip()}")
+    if product_info.condition_status:
+        details.append(f"🏷️ {product_info.condition_status}")
+    if product_info.coupon:
+        details.append("🎟️ Coupon")
+    if details:
+        entry += ' | '.join(details) + '\n'
+    entry += short_url
+    return entry
+
+def split_batch_post(header: str, entries: list, limit: int = 4096) -> list:
+    posts = []
+    current = header
+    for entry in entries:
+        if len(current) + len(entry) + 2 > limit:
+            posts.append(current)
+            current = ''
+        current += ('\n\n' if current else '') + entry
+    if current:
+        posts.append(current)
+    return posts
+
+async def handle_batch(update: Update, urls: list, job: str = None) -> None:
+    user = update.message.from_user
+    urls = urls[:BATCH_MAX_LINKS]
+    
+    # Links that already carry an ASIN are deduplicated before any request
+    unique_urls = []
+    seen = set()
+    for url in urls:
+        key = extract_asin_from_url(url) or url
+        if key not in seen:
+            seen.add(key)
+            unique_urls.append(url)
+    
+    logger.info("Batch from %s: %s link(s)", user.username, len(unique_urls))
+    status_msg = StatusMessage(update.message, f"⏳ Elaborando {len(unique_urls)} link...")
+    pending_work.track_status(job, status_msg)
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run(url):
+        async with slots:
             try:
-                await update.message.chat.send_photo(
-                    photo=product_info['image'],
-                    caption=message,
-                    parse_mode='HTML'
-                )
-                logger.info("Sent photo")
+                return await process_batch_link(url)
             except Exception as e:
-                logger.warning(f"Photo error: {e}")
-                fallback = f"<b>{product_info.get('title', 'Prodotto')}</b>\n\n{short_url}"
-                try:
-                    await update.message.chat.send_message(fallback, parse_mode='HTML')
-                except:
-                    await update.message.chat.send_message(f"Link: {short_url}")
+                logger.error("Batch link error for %s: %s", url, e)
+                trace_failed(type(e).__name__)
+                return None
+    
+    with timed_stage('batch'):
+        results = await asyncio.gather(*[run(url) for url in unique_urls])
+    
+    items = []
+    seen = set()
+    for result in results:
+        if result is None or result[0] in seen:
+            continue
+        seen.add(result[0])
+        items.append(result[1:])
+    
+    if not items:
+        status_msg.edit("❌ Errore.\nRiprova.")
+        return
+    
+    status_msg.delete()
+    run_in_background(delete_quietly(update.message))
+    
+    chat = update.message.chat
+    header = f"<b>👤 {user.first_name}</b> ha condiviso {len(items)} prodotti:"
+    with timed_stage('send'):
+        if BATCH_REPLY_MODE == 'album':
+            await send_batch_album(chat, header, items)
         else:
-            logger.info("No image")
-            try:
-                await update.message.chat.send_message(message, parse_mode='HTML')
-            except:
-                fallback = f"<b>{product_info.get('title', 'Prodotto')}</b>\n\n{short_url}"
-                await update.message.chat.send_message(fallback, parse_mode='HTML')
-        
-    except Exception as e:
-        logger.error(f"Error: {e}")
+            entries = [build_batch_entry(i, product_info, short_url) for i, (product_info, short_url) in enumerate(items, 1)]
+            for post in split_batch_post(header, entries):
+                await chat.send_message(post, parse_mode='HTML', disable_web_page_preview=True)
+
+async def send_batch_album(chat, header: str, items: list) -> None:
+    from telegram import InputMediaPhoto
+    with_image = []
+    images = []
+    without_image = []
+    for index, (product_info, short_url) in enumerate(items, 1):
+        entry = build_batch_entry(index, product_info, short_url)
+        if product_info.image:
+            media = cached_photo(product_info.image) or product_info.image
+            with_image.append(InputMediaPhoto(media=media, caption=entry, parse_mode='HTML'))
+            images.append(product_info.image)
+        else:
+            without_image.append(entry)
+    
+    await chat.send_message(header, parse_mode='HTML')
+    for start in range(0, len(with_image), 10):
+        group = with_image[start:start + 10]
         try:
-            await status_msg.edit_text("❌ Errore.\nRiprova.")
-        except:
-            pass
+            if len(group) == 1:
+                sent = [await chat.send_photo(photo=group[0].media, caption=group[0].caption, parse_mode='HTML')]
+            else:
+                sent = await chat.send_media_group(group)
+            for image_url, message in zip(images[start:start + 10], sent):
+                remember_photo(image_url, message)
+        except Exception as e:
+            logger.warning("Album error: %s", e)
+            PHOTO_SEND_FAILURES.inc()
+            without_image.extend(media.caption for media in group)
+    
+    for post in split_batch_post('', without_image):
+        await chat.send_message(post, parse_mode='HTML', disable_web_page_preview=True)
 
 def format_promotion_text(promotion: str) -> str:
     if not promotion:
@@ -453,32 +2900,25 @@ def format_promotion_text(promotion: str) -> str:
     
     result = promotion
     
-    patterns = [
-        (r'(\d+(?:[.,]\d{2})?€)', lambda m: f'<b>{m.group(1)}</b>'),
-        (r'(\d+%)', lambda m: f'<b>{m.group(1)}</b>'),
-        (r'(Mediano:)', lambda m: f'<b>{m.group(1)}</b>'),
-    ]
-    
-    for pattern, replacement in patterns:
-        result = re.sub(pattern, replacement, result)
+    for pattern in PROMO_PATTERNS:
+        result = pattern.sub(r'<b>\1</b>', result)
     
-    result = re.sub(r'(\d+(?:[.,]\d{2})?€)\s*(\d+(?:[.,]\d{2})?€)', 
-                    r'<b>\1</b> <b>\2</b>', result)
+    result = PROMO_PRICE_PAIR_RE.sub(r'<b>\1</b> <b>\2</b>', result)
     
     return result
 
-def build_product_message(product_info: dict, short_url: str, user_name: str = None) -> str:
-    title = product_info.get('title', 'Prodotto Amazon')
-    price = product_info.get('price', '')
-    rating = product_info.get('rating', '')
-    condition = product_info.get('condition_status', '')
-    description = product_info.get('description', '')
-    promotion = product_info.get('promotion', '')
-    coupon = product_info.get('coupon', '')
+def build_product_message(product_info: ProductInfo, short_url: str, user_name: str = None) -> str:
+    title = product_info.title or DEFAULT_PRODUCT_TITLE
+    price = product_info.price
+    rating = product_info.rating
+    condition = product_info.condition_status
+    description = product_info.description
+    promotion = product_info.promotion
+    coupon = product_info.coupon
     
     clean_price = ''
     if price:
-        clean_price = re.sub(r'€.*', '€', price).strip()
+        clean_price = PRICE_SUFFIX_RE.sub('€', price).strip()
     
     rating_stars = ''
     if rating:
@@ -546,7 +2986,7 @@ def is_short_amazon_url(url: str) -> bool:
         return False
 
 def add_affiliate_tag(url: str, tag: str) -> str:
-    url = re.sub(r'[?&]tag=[^&]*', '', url)
+    url = TAG_PARAM_RE.sub('', url)
     # Ensure slash before query params
     if '?' in url:
         parts = url.split('?', 1)
@@ -558,11 +2998,39 @@ def add_affiliate_tag(url: str, tag: str) -> str:
         url = url.rstrip('/') + '/?'
         return f"{url}tag={tag}"
 
+def remember_short_link(url: str, short_url: str) -> None:
+    if not short_url:
+        return
+    try:
+        short_link_memo.set(url, short_url)
+    except sqlite3.Error as e:
+        logger.warning("Could not store short link: %s", e)
+
+def memoized_short_link(url: str):
+    try:
+        return short_link_memo.get(url.replace('?&', '?'))
+    except sqlite3.Error as e:
+        logger.warning("Short link memo unavailable: %s", e)
+        return None
+
 async def shorten_with_yourls(url: str) -> str:
+    short_url = await shorten_flight.run(url.replace('?&', '?'), lambda: _shorten_with_yourls(url))
+    if short_url == url.replace('?&', '?'):
+        trace_failed('yourls_fallback')
+    return short_url
+
+async def _shorten_with_yourls(url: str) -> str:
+    import httpx
     try:
         api_url = f"{YOURLS_URL}/yourls-api.php"
         url = url.replace('?&', '?')
         
+        memo = memoized_short_link(url)
+        if memo:
+            logger.debug("Short link memo hit: %s", memo)
+            trace_event('short_link_memo')
+            return memo
+        
         data = {
             'signature': YOURLS_SIGNATURE,
             'action': 'shorturl',
@@ -570,58 +3038,606 @@ async def shorten_with_yourls(url: str) -> str:
             'url': url
         }
         
-        logger.info(f"Shortening: {url}")
-        logger.info(f"API URL: {api_url}")
+        logger.debug("Shortening: %s", url)
+        logger.debug("API URL: %s", api_url)
+        
+        if not yourls_breaker.allow():
+            logger.warning("YOURLS circuit open - returning original URL")
+            YOURLS_FALLBACKS.inc('circuit_open')
+            return url
         
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
+            await yourls_limiter.acquire()
+            client = get_yourls_client()
+            with timed_stage('shorten'):
                 response = await client.post(api_url, data=data)
-                logger.info(f"Status: {response.status_code}")
-                logger.info(f"Response: {response.text[:200]}")
-                
-                try:
-                    result = response.json()
-                except Exception as e:
-                    logger.error(f"JSON parse error: {e}")
-                    logger.error(f"Raw: {response.text}")
-                    logger.warning("YOURLS JSON error - returning original URL")
-                    return url
-                
-                logger.info(f"Result: {result}")
+            logger.debug("Status: %s", response.status_code)
+            if response.status_code != 200:
+                UPSTREAM_ERRORS.inc('yourls', str(response.status_code))
+            if response.status_code in (429, 503):
+                yourls_limiter.on_throttle()
+            if response.status_code >= 500 or response.status_code == 429:
+                yourls_breaker.record_failure()
+            else:
+                yourls_breaker.record_success()
+                yourls_limiter.on_success()
+            logger.debug("Response: %s", response.text[:200])
+            
+            try:
+                result = response.json()
+            except Exception as e:
+                logger.error("JSON parse error: %s", e)
+                logger.error("Raw: %s", response.text[:500])
+                logger.warning("YOURLS JSON error - returning original URL")
+                YOURLS_FALLBACKS.inc('json')
+                return url
+            
+            logger.debug("Result: %s", result)
+            
+            if result.get('status') == 'success':
+                short = result.get('shorturl')
+                logger.debug("Shortened: %s", short)
+                remember_short_link(url, short)
+                return short
+            else:
+                if 'already exists' in result.get('message', ''):
+                    kw = result.get('url', {}).get('keyword')
+                    if kw:
+                        short = f"{YOURLS_URL}/{kw}"
+                        logger.debug("Exists: %s", short)
+                        remember_short_link(url, short)
+                        return short
                 
-                if result.get('status') == 'success':
-                    short = result.get('shorturl')
-                    logger.info(f"Shortened: {short}")
-                    return short
-                else:
-                    if 'already exists' in result.get('message', ''):
-                        kw = result.get('url', {}).get('keyword')
-                        if kw:
-                            short = f"{YOURLS_URL}/{kw}"
-                            logger.info(f"Exists: {short}")
-                            return short
-                    
-                    logger.error(f"Error: {result.get('message', 'Unknown')}")
-                    logger.warning("YOURLS error - returning original URL")
-                    return url
+                logger.error("Error: %s", result.get('message', 'Unknown'))
+                logger.warning("YOURLS error - returning original URL")
+                YOURLS_FALLBACKS.inc('api_error')
+                return url
         
         except (httpx.TimeoutException, httpx.ConnectError) as e:
-            logger.error(f"YOURLS timeout/connection error: {e}")
+            logger.error("YOURLS timeout/connection error: %s", e)
             logger.warning("YOURLS unreachable - returning original URL as fallback")
+            UPSTREAM_ERRORS.inc('yourls', 'error')
+            yourls_breaker.record_failure()
+            YOURLS_FALLBACKS.inc('unreachable')
             return url
                 
     except Exception as e:
-        logger.error(f"Error: {e}", exc_info=True)
+        logger.error("Error: %s", e, exc_info=True)
         logger.warning("Unexpected error - returning original URL")
+        YOURLS_FALLBACKS.inc('unexpected')
         return url
 
-def main():
-    start_health_check_server()
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+# PTB's own limit on concurrent updates; the real one is UPDATE_CONCURRENCY
+UNLIMITED_UPDATES = 1_000_000
+# At shutdown, handlers still running after this many seconds are cancelled
+# and their link messages saved for the next process
+HANDLER_STOP_GRACE = 20
+
+def build_update_processor(max_concurrent_updates: int):
+    # Defined on first use: the base class would pull in telegram.ext at import time
+    from telegram.ext import BaseUpdateProcessor
+
+    class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+        """Processes updates concurrently while keeping them in order within each chat.
+
+        PTB takes its concurrency slot before do_process_update, so that limit
+        is set out of reach and the real one is taken only by the update at the
+        head of its chat: a burst from one chat waits on its own chat lock
+        without holding slots that other chats need.
+        """
+
+        def __init__(self, max_concurrent_updates: int):
+            super().__init__(UNLIMITED_UPDATES)
+            self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+            self._chat_locks = {}
+            self._chat_pending = {}
+            # stats() runs in the health-check thread
+            self._stats_lock = threading.Lock()
+            self._tasks = set()
+            self.processed = 0
+
+        async def do_process_update(self, update, coroutine) -> None:
+            task = asyncio.current_task()
+            self._tasks.add(task)
+            try:
+                await self._process_in_order(update, coroutine)
+            finally:
+                self._tasks.discard(task)
+                # No-op once awaited; avoids a warning for updates cancelled while queued
+                coroutine.close()
+
+        async def _process_in_order(self, update, coroutine) -> None:
+            chat = getattr(update, 'effective_chat', None)
+            if chat is None:
+                try:
+                    async with self._slots:
+                        await coroutine
+                finally:
+                    self.processed += 1
+                    mark_startup('first_update')
+                return
+            chat_id = chat.id
+            pending_work.add_update(update)
+            lock = self._chat_locks.get(chat_id)
+            if lock is None:
+                lock = self._chat_locks[chat_id] = asyncio.Lock()
+            with self._stats_lock:
+                self._chat_pending[chat_id] = self._chat_pending.get(chat_id, 0) + 1
+            try:
+                async with lock:
+                    async with self._slots:
+                        await coroutine
+            finally:
+                self.processed += 1
+                mark_startup('first_update')
+                with self._stats_lock:
+                    self._chat_pending[chat_id] -= 1
+                    if not self._chat_pending[chat_id]:
+                        del self._chat_pending[chat_id]
+                        del self._chat_locks[chat_id]
+
+        async def cancel_running(self, grace: float) -> None:
+            """Give the updates being processed grace seconds, then cancel the rest."""
+            if not self._tasks:
+                return
+            _, running = await asyncio.wait(set(self._tasks), timeout=grace)
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        def stats(self) -> dict:
+            with self._stats_lock:
+                counts = list(self._chat_pending.values())
+            pending = sum(counts)
+            return {
+                'active_chats': len(counts),
+                'pending': pending,
+                'queued_behind_chat': pending - len(counts),
+                'max_chat_queue': max(counts, default=0),
+                'processed': self.processed,
+            }
+
+    return ChatOrderedUpdateProcessor(max_concurrent_updates)
+
+update_processor = None
+
+SNAPSHOT_PRODUCTS_COLUMNS = '(key TEXT PRIMARY KEY, packed TEXT NOT NULL, age REAL NOT NULL, saved_at REAL NOT NULL)'
+# Products written per turn on _state_db_lock; between batches the bot's own lookups get the DB
+SNAPSHOT_BATCH_ROWS = 500
+# A periodic save still running at shutdown must not share the staging table
+_snapshot_lock = threading.Lock()
+
+def _create_snapshot_tables(db: sqlite3.Connection) -> None:
+    db.execute(f'CREATE TABLE IF NOT EXISTS snapshot_products {SNAPSHOT_PRODUCTS_COLUMNS}')
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS snapshot_pending '
+        '(mode TEXT NOT NULL, key TEXT NOT NULL, job TEXT NOT NULL, PRIMARY KEY (mode, key))'
+    )
+
+def _in_transaction(db: sqlite3.Connection, statements) -> None:
+    db.execute('BEGIN')
+    try:
+        for sql, params in statements:
+            if isinstance(params, list):
+                db.executemany(sql, params)
+            else:
+                db.execute(sql, params)
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+def save_snapshot(include_pending: bool) -> None:
+    """Write the product cache (and, at shutdown, unfinished link messages) to the state DB.
+
+    Short links and resolved redirects need no snapshot: they are written to
+    the state DB as they are learned. Rows are encoded before touching the DB
+    and written into a staging table in batches, taking _state_db_lock for
+    one batch at a time; the staging table replaces the old one in a last
+    short transaction.
+    """
+    started = time.monotonic()
+    saved_at = time.time()
+    rows = [(key, json.dumps(packed, ensure_ascii=False), age, saved_at) for key, packed, age in product_cache.snapshot()]
+    jobs = pending_work.export() if include_pending else []
+    pending_rows = [(BOT_MODE, f"{job['chat_id']}:{job['message_id']}", json.dumps(job, ensure_ascii=False)) for job in jobs]
+    db = get_state_db()
+    with _snapshot_lock:
+        with _state_db_lock:
+            _create_snapshot_tables(db)
+            # Left behind by a save that did not finish
+            db.execute('DROP TABLE IF EXISTS snapshot_products_old')
+            db.execute('DROP TABLE IF EXISTS snapshot_products_new')
+            db.execute(f'CREATE TABLE snapshot_products_new {SNAPSHOT_PRODUCTS_COLUMNS}')
+        for i in range(0, len(rows), SNAPSHOT_BATCH_ROWS):
+            with _state_db_lock:
+                _in_transaction(db, [(
+                    'INSERT INTO snapshot_products_new (key, packed, age, saved_at) VALUES (?, ?, ?, ?)',
+                    rows[i:i + SNAPSHOT_BATCH_ROWS],
+                )])
+        statements = [
+            ('ALTER TABLE snapshot_products RENAME TO snapshot_products_old', ()),
+            ('ALTER TABLE snapshot_products_new RENAME TO snapshot_products', ()),
+        ]
+        if include_pending:
+            statements += [
+                ('DELETE FROM snapshot_pending WHERE mode = ?', (BOT_MODE,)),
+                ('INSERT OR REPLACE INTO snapshot_pending (mode, key, job) VALUES (?, ?, ?)', pending_rows),
+            ]
+        with _state_db_lock:
+            _in_transaction(db, statements)
+        # Dropping the old table in one go would hold the lock for as long as a batch of inserts times twenty
+        while True:
+            with _state_db_lock:
+                deleted = db.execute(
+                    'DELETE FROM snapshot_products_old WHERE rowid IN (SELECT rowid FROM snapshot_products_old LIMIT ?)',
+                    (SNAPSHOT_BATCH_ROWS,),
+                ).rowcount
+                if not deleted:
+                    db.execute('DROP TABLE snapshot_products_old')
+                    break
+    logger.info("Snapshot saved: %s products, %s pending messages in %.2fs", len(rows), len(jobs), time.monotonic() - started)
+
+_restored_jobs = []
+
+def load_snapshot() -> None:
+    started = time.monotonic()
+    db = get_state_db()
+    with _state_db_lock:
+        _create_snapshot_tables(db)
+        rows = db.execute('SELECT key, packed, age, saved_at FROM snapshot_products ORDER BY age DESC').fetchall()
+        # Only the rows of this BOT_MODE: the state DB may be shared with
+        # processes running in other modes
+        jobs = [json.loads(row[0]) for row in db.execute('SELECT job FROM snapshot_pending WHERE mode = ?', (BOT_MODE,)).fetchall()]
+        # Taken over by this process: from now on they live in pending_work
+        db.execute('DELETE FROM snapshot_pending WHERE mode = ?', (BOT_MODE,))
+    now = time.time()
+    restored = product_cache.restore(
+        (key, json.loads(packed), age + max(0.0, now - saved_at)) for key, packed, age, saved_at in rows
+    )
+    for job in jobs:
+        if now - job.get('received_at', 0) > PENDING_WORK_MAX_AGE:
+            continue
+        job['key'] = pending_work.add(job)
+        _restored_jobs.append(job)
+    logger.info("Snapshot loaded: %s products, %s pending messages in %.2fs", restored, len(_restored_jobs), time.monotonic() - started)
+
+async def collect_job_items(job: dict) -> list:
+    items = []
+    seen = set()
+    for url in job['urls'][:BATCH_MAX_LINKS]:
+        key, product_info, short_url = await process_batch_link(url)
+        if key not in seen:
+            seen.add(key)
+            items.append((product_info, short_url))
+    return items
+
+async def replay_job(bot, job: dict) -> None:
+    await post_job_items(bot, job, await collect_job_items(job))
+
+async def post_job_items(bot, job: dict, items: list, sent: list = None) -> None:
+    """Post the job's products; every message that went out is appended to sent.
+
+    The "⏳ In coda..." status is deleted only once everything is posted, so
+    a failure can still be reported on it.
+    """
+    chat_id = job['chat_id']
+    sent = [] if sent is None else sent
+    if len(items) == 1:
+        product_info, short_url = items[0]
+        message = build_product_message(product_info, short_url, job.get('first_name'))
+        await send_product_post(bot, chat_id, product_info, message, short_url)
+        sent.append(0)
+    else:
+        header = f"<b>👤 {job.get('first_name') or 'Utente'}</b> ha condiviso {len(items)} prodotti:"
+        entries = [build_batch_entry(i, product_info, short_url) for i, (product_info, short_url) in enumerate(items, 1)]
+        for i, post in enumerate(split_batch_post(header, entries)):
+            await bot.send_message(chat_id, post, parse_mode='HTML', disable_web_page_preview=True)
+            sent.append(i)
+    for message_id in (job.get('status_message_id'), job['message_id']):
+        if message_id:
+            try:
+                await bot.delete_message(chat_id, message_id)
+            except Exception:
+                pass
+
+async def replay_pending_work(bot) -> None:
+    """Finish the link messages a previous process was handling when it stopped."""
+    while _restored_jobs:
+        job = _restored_jobs.pop(0)
+        logger.info("Replaying message %s from chat %s", job['message_id'], job['chat_id'])
+        try:
+            if BOT_MODE == 'frontend':
+                await queue_job(bot, {k: v for k, v in job.items() if k != 'key'})
+            else:
+                await replay_job(bot, job)
+        except Exception as e:
+            logger.error("Replay error: %s", e)
+        pending_work.done(job['key'])
+
+async def snapshot_loop() -> None:
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await asyncio.to_thread(save_snapshot, False)
+        except Exception as e:
+            logger.error("Snapshot error: %s", e)
+
+_snapshot_task = None
+
+LOOP_LAG_INTERVAL = 0.5
+_loop_lags = deque(maxlen=120)
+
+def loop_lag_stats() -> dict:
+    lags = list(_loop_lags)
+    return {
+        'last': round(lags[-1], 4) if lags else 0.0,
+        'max_1m': round(max(lags), 4) if lags else 0.0,
+    }
+
+async def monitor_loop_lag() -> None:
+    # Any time past the requested sleep is time the loop spent busy elsewhere
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        _loop_lags.append(max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+async def run_job(bot, queue, key: str, job: dict, attempt: int) -> None:
+    job_stats['running'] += 1
+    try:
+        with start_trace('job', chat_id=job['chat_id'], links=len(job['urls']), attempt=attempt):
+            sent = []
+            try:
+                items = await collect_job_items(job)
+                # Only an Amazon that could not be reached is worth another try:
+                # a page without product data would just come back the same
+                if attempt < JOB_MAX_ATTEMPTS and any(product_info.unavailable for product_info, _ in items):
+                    raise ConnectionError("Amazon unavailable")
+                await post_job_items(bot, job, items, sent)
+            except Exception as e:
+                trace_failed(type(e).__name__)
+                # Once a post is in the chat a retry would send it again
+                if attempt < JOB_MAX_ATTEMPTS and not sent:
+                    delay = JOB_RETRY_DELAY * 2 ** (attempt - 1)
+                    logger.warning("Job %s attempt %s failed (%s), retrying in %.0fs", key, attempt, e, delay)
+                    await queue.retry(key, delay)
+                    job_stats['retried'] += 1
+                    return
+                logger.error("Job %s failed: %s", key, e)
+                await queue.fail(key)
+                job_stats['failed'] += 1
+                if job.get('status_message_id'):
+                    try:
+                        await bot.edit_message_text("❌ Errore.\nRiprova.", chat_id=job['chat_id'], message_id=job['status_message_id'])
+                    except Exception:
+                        pass
+                return
+        await queue.complete(key)
+        job_stats['done'] += 1
+    finally:
+        job_stats['running'] -= 1
+
+async def job_worker(bot, queue, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            claimed = await queue.claim()
+        except Exception as e:
+            logger.error("Job queue error: %s", e)
+            claimed = None
+        if claimed is None:
+            try:
+                await asyncio.wait_for(stop.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        key, job, attempt = claimed
+        try:
+            await run_job(bot, queue, key, job, attempt)
+        except asyncio.CancelledError:
+            await queue.release(key)
+            raise
+        except Exception as e:
+            logger.error("Job queue error: %s", e)
+
+WORKER_STOP_GRACE = 20
+
+async def run_worker() -> None:
+    """BOT_MODE=worker: run queued link jobs and post the results, without receiving updates."""
+    from telegram import Bot
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    queue = get_job_queue()
+    api_urls = {}
+    if TELEGRAM_API_URL:
+        api_urls = {'base_url': f"{TELEGRAM_API_URL}/bot", 'base_file_url': f"{TELEGRAM_API_URL}/file/bot"}
+    async with Bot(TELEGRAM_TOKEN, **api_urls) as bot:
+        mark_startup('bot_ready')
+        run_in_background(warm_up())
+        run_in_background(monitor_loop_lag())
+        workers = [asyncio.create_task(job_worker(bot, queue, stop)) for _ in range(WORKER_CONCURRENCY)]
+        logger.info("Worker started: %s jobs at a time from the %s queue", WORKER_CONCURRENCY, queue.name)
+        await stop.wait()
+        logger.info("Stopping worker")
+        # Jobs still running after the grace period go back to the queue
+        _, running = await asyncio.wait(workers, timeout=WORKER_STOP_GRACE)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+    await close_http_clients()
+    shutdown_parse_pool()
+
+def _warm_parse_worker() -> int:
+    return os.getpid()
+
+async def warm_up() -> None:
+    """Pay the remaining one-off start-up costs before the first link needs them."""
+    if HTML_EXTRACTOR == 'soup':
+        await asyncio.to_thread(importlib.import_module, 'bs4')
+    executor = get_parse_executor()
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(executor, _warm_parse_worker) for _ in range(PARSE_WORKERS)])
+    get_amazon_client()
+    get_yourls_client()
+    mark_startup('warm')
+
+async def on_startup(app: Application) -> None:
+    global _snapshot_task
+    mark_startup('bot_ready')
+    start_price_watcher(app)
+    run_in_background(warm_up())
+    run_in_background(monitor_loop_lag())
+    if _restored_jobs:
+        run_in_background(replay_pending_work(app.bot))
+    if SNAPSHOT_INTERVAL > 0 and _snapshot_task is None:
+        _snapshot_task = run_in_background(snapshot_loop())
+
+async def on_shutdown(app: Application) -> None:
+    stop_price_watcher()
+    await close_http_clients(app)
+    shutdown_parse_pool()
+
+async def stop_application(app: Application) -> None:
+    """Stop the bot, saving the link messages it has not finished for the next process.
+
+    Application.stop() waits for every running handler, so the snapshot is
+    taken before it: handlers still running after HANDLER_STOP_GRACE are
+    cancelled, which leaves their messages in pending_work.
+    """
+    global _snapshot_task
+    if app.updater is not None and app.updater.running:
+        await app.updater.stop()
+    if _snapshot_task is not None:
+        _snapshot_task.cancel()
+        _snapshot_task = None
+    await update_processor.cancel_running(HANDLER_STOP_GRACE)
+    try:
+        await asyncio.to_thread(save_snapshot, True)
+    except Exception as e:
+        logger.error("Snapshot error: %s", e)
+    await app.stop()
+    await on_shutdown(app)
+
+def make_webhook_route(app_ready: asyncio.Future):
+    async def webhook_route(method: str, path: str, headers: dict, read_body):
+        if method != 'POST':
+            return 405, 'text/plain', b'POST only'
+        if headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            logger.warning("Webhook call with wrong secret token")
+            return 403, 'text/plain', b'Forbidden'
+        body = await read_body()
+        # The update that woke the container arrives while the bot is still being built
+        app = await asyncio.shield(app_ready)
+        from telegram import Update
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except ValueError as e:
+            logger.warning("Invalid webhook payload: %s", e)
+            return 400, 'text/plain', b'Invalid update'
+        await app.update_queue.put(update)
+        return 200, 'text/plain', b'OK'
+    return webhook_route
+
+async def run_webhook() -> None:
+    # Telegram updates, /health, /stats and /metrics share one asyncio server
+    # on PORT, running in the bot's own event loop. It listens before the bot
+    # is built, so health checks answer during the slow part of start-up.
+    loop = asyncio.get_running_loop()
+    app_ready = loop.create_future()
+    HTTP_ROUTES[WEBHOOK_PATH] = make_webhook_route(app_ready)
+    server = await asyncio.start_server(handle_http, '0.0.0.0', PORT)
+    logger.info("HTTP server started on port %s", PORT)
+    mark_startup('health_ready')
+    
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    try:
+        await asyncio.to_thread(load_snapshot)
+        await asyncio.to_thread(importlib.import_module, 'telegram.ext')
+        app = build_application()
+        app_ready.set_result(app)
+        from telegram import Update
+        async with app:
+            await app.bot.set_webhook(
+                url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=WEBHOOK_SECRET,
+            )
+            logger.info("Webhook set to %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+            await app.start()
+            await on_startup(app)
+            await stop.wait()
+            logger.info("Stopping bot")
+            await stop_application(app)
+    finally:
+        server.close()
+        await server.wait_closed()
+
+async def run_polling() -> None:
+    # Run by hand rather than with Application.run_polling, which stops the
+    # application before any hook could save the unfinished messages
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    load_snapshot()
+    app = build_application()
+    from telegram import Update
+    async with app:
+        await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await app.start()
+        await on_startup(app)
+        await stop.wait()
+        logger.info("Stopping bot")
+        await stop_application(app)
+
+def build_application() -> Application:
+    global update_processor
+    from telegram.ext import Application, CommandHandler, InlineQueryHandler, MessageHandler, filters
+    update_processor = build_update_processor(UPDATE_CONCURRENCY)
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(update_processor)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if WEBHOOK_URL:
+        builder = builder.updater(None)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("watch", watch_command))
+    app.add_handler(CommandHandler("unwatch", unwatch_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url))
+    app.add_handler(InlineQueryHandler(inline_query))
+    mark_startup('app_built')
+    return app
+
+def main():
+    if BOT_MODE == 'worker':
+        logger.info("Bot started (worker)")
+        start_health_check_server()
+        asyncio.run(run_worker())
+        return
+    if WEBHOOK_URL:
+        logger.info("Bot started (webhook)")
+        asyncio.run(run_webhook())
+        return
+    start_health_check_server()
     logger.info("Bot started")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    asyncio.run(run_polling())
 
 if __name__ == '__main__':
     main()